@@ -0,0 +1,735 @@
+"""Benchmarks for the Markov module. Run from the bot's root directory, e.g.
+
+    python subs/markov/benchmark.py combine
+    python subs/markov/benchmark.py load --people 200 --messages 500 --json results.json
+    python subs/markov/benchmark.py check
+
+Synthetic people are written to a temporary directory, so the real people repo is never touched."""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import product
+
+import markovify
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import markov
+
+VOCABULARY_SIZE = 5000
+
+
+def synthetic_lines(rng, num_messages):
+    """Returns num_messages messages of 3 to 20 words drawn from a Zipf-distributed vocabulary."""
+    vocabulary = [f'word{i}' for i in range(VOCABULARY_SIZE)]
+    weights = [1 / (rank + 1) for rank in range(VOCABULARY_SIZE)]
+    return [' '.join(rng.choices(vocabulary, weights, k=rng.randint(3, 20))) for _ in range(num_messages)]
+
+
+def build_people(repo, num_people, num_messages, seed=0):
+    """Writes num_people synthetic people with num_messages messages each to repo and returns their names."""
+    rng = random.Random(seed)
+    names = []
+    markov.PEOPLE_REPO = repo
+    markov.VALID_NAMES = None
+    for index in range(num_people):
+        lines = synthetic_lines(rng, num_messages)
+        name = f'person{index}'
+        markov.save_person_model(name, markovify.NewlineText('\n'.join(lines)))
+        names.append(name)
+    return names
+
+
+def time_calls(func, iterations):
+    """Calls func iterations times and returns the mean time per call in milliseconds."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) * 1000 / iterations
+
+
+class FakeAuthor():
+    """Stands in for a discord.Member in the update path."""
+
+    def __init__(self, id, name, bot=False):
+        self.id = id
+        self.name = name
+        self.bot = bot
+
+
+class FakeMessage():
+    """Stands in for a discord.Message in the update path."""
+
+    def __init__(self, author, content, created_at):
+        self.author = author
+        self.content = content
+        self.created_at = created_at
+
+
+def fake_messages(rng, authors, num_messages):
+    """Returns num_messages messages from randomly chosen authors, oldest first."""
+    start = datetime.datetime(2018, 1, 1)
+    contents = synthetic_lines(rng, num_messages)
+    return [FakeMessage(rng.choice(authors), content, start + datetime.timedelta(seconds=index))
+            for index, content in enumerate(contents)]
+
+
+def percentile(sorted_values, percent):
+    """Returns the nearest-rank percentile of a sorted list."""
+    return sorted_values[min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))]
+
+
+def measure(func, iterations, concurrency=1, memory_iterations=5):
+    """Calls func iterations times from concurrency threads and returns its latency percentiles in milliseconds,
+    its throughput in calls per second and the peak memory allocated by memory_iterations further calls.
+
+    func is called with the index of the call."""
+    def timed(index):
+        start = time.perf_counter()
+        func(index)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(timed, range(iterations)))
+    else:
+        latencies = [timed(index) for index in range(iterations)]
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    for index in range(iterations, iterations + memory_iterations):
+        func(index)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = sorted(latency * 1000 for latency in latencies)
+    return {
+        'calls': iterations,
+        'concurrency': concurrency,
+        'mean_ms': sum(latencies) / len(latencies),
+        'p50_ms': percentile(latencies, 50),
+        'p90_ms': percentile(latencies, 90),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1],
+        'throughput_per_s': iterations / elapsed,
+        'peak_memory_mib': peak_memory / 2 ** 20,
+    }
+
+
+def bench_combine(args):
+    """Compares combining models on every request with the combined-model cache and mixture sampling."""
+    with tempfile.TemporaryDirectory() as repo:
+        names = build_people(f'{repo}/', args.people, args.messages)
+        groups = [random.sample(names, args.group_size) for _ in range(args.groups)]
+
+        def per_request():
+            models = markov.generate_models(markov.PEOPLE_REPO, random.choice(groups))
+            markov.combine_models(models).make_sentence(tries=markov.MAX_MARKOV_ATTEMPTS)
+
+        def with_mode(mode):
+            def run():
+                markov.COMBINE_MODE = mode
+                markov.get_combined_model(random.choice(groups)).make_sentence(tries=markov.MAX_MARKOV_ATTEMPTS)
+            return run
+
+        for label, func in (('combine per request', per_request), ('combined cache', with_mode('cache')),
+                            ('mixture sampling', with_mode('mixture'))):
+            print(f'{label:>20}: {time_calls(func, args.iterations):8.2f} ms/request')
+
+
+def legacy_is_valid_sentence(homosexual, gay, sentence, gender1_tag):
+    """The original list-based is_valid_sentence, kept as the baseline for bench_sentences."""
+    masculine_words = list(markov.get_masculine_words())
+    feminine_words = list(markov.get_feminine_words())
+    sentence_words = [''.join(c for c in word if c not in string.punctuation) for word in sentence.lower().split()]
+    tags = [word.strip("'s") for word in sentence.split() if '$' in word]
+
+    if not homosexual and 'ALE2' in sentence:
+        return False
+
+    is_tags_same_length = True
+    if len(tags) > 0:
+        tag_len = len(tags[0])
+        if len(gender1_tag) != tag_len:
+            is_tags_same_length = False
+        else:
+            for tag in tags:
+                if tag_len != len(tag):
+                    is_tags_same_length = False
+
+    if homosexual and not is_tags_same_length:
+        return False
+
+    if homosexual:
+        if gay:
+            for feminine_word, word in product(feminine_words, sentence_words):
+                if word == feminine_word:
+                    return False
+        else:
+            for masculine_word, word in product(masculine_words, sentence_words):
+                if word == masculine_word:
+                    return False
+    return True
+
+
+def bench_sentences(args):
+    """Compares the per-sentence cost of the original and current is_valid_sentence on fanfic sentences."""
+    fanfic_model = markov.get_fanfic_model()
+    sentences = [fanfic_model.make_sentence() + ' ' for _ in range(args.sentences)]
+    configurations = ((False, False, '$MALE1'), (True, True, '$MALE1'), (True, False, '$FEMALE1'))
+
+    for label, func in (('original', legacy_is_valid_sentence), ('current', markov.is_valid_sentence)):
+        def run():
+            for homosexual, gay, gender1_tag in configurations:
+                for sentence in sentences:
+                    func(homosexual, gay, sentence, gender1_tag)
+        per_sentence = time_calls(run, args.iterations) * 1000 / (len(sentences) * len(configurations))
+        print(f'{label:>10}: {per_sentence:8.2f} us/sentence')
+
+
+def legacy_find(name, valid_names):
+    """The original linear scan parse_names used to resolve one name, kept as the baseline for bench_names."""
+    current_name = []
+    for valid_name in valid_names:
+        if name == valid_name:
+            return [valid_name]
+        if name in valid_name:
+            current_name.append(valid_name)
+    return current_name
+
+
+def bench_names(args):
+    """Compares resolving partial names with a linear scan of a list and with the NameRegistry index."""
+    rng = random.Random(0)
+    names = list(dict.fromkeys(''.join(rng.choices(string.ascii_lowercase + string.digits, k=rng.randint(4, 14)))
+                               for _ in range(args.names)))
+    registry = markov.NameRegistry(names)
+    queries = []
+    for _ in range(args.queries):
+        name = rng.choice(names)
+        start = rng.randint(0, len(name) - 3)
+        queries.append([name[start:start + rng.randint(3, len(name) - start)] for _ in range(markov.MAX_NUM_OF_NAMES)])
+
+    for query in queries:
+        for name in query:
+            assert legacy_find(name, names) == registry.find(name)
+
+    for label, func in (('list scan', lambda name: legacy_find(name, names)), ('registry', registry.find)):
+        def run():
+            for query in queries:
+                for name in query:
+                    func(name)
+        per_query = time_calls(run, args.iterations) / len(queries)
+        print(f'{label:>10}: {per_query:8.3f} ms per {markov.MAX_NUM_OF_NAMES}-name query ({len(names)} names)')
+
+
+STARTUP_SCRIPT = """
+import sys, time
+sys.path.insert(0, sys.argv[1])
+start = time.perf_counter()
+import markov
+imported = time.perf_counter()
+markov.get_valid_names()
+scanned = time.perf_counter()
+markov.get_valid_names()
+print(imported - start, scanned - imported, time.perf_counter() - scanned)
+"""
+
+
+def bench_startup(args):
+    """Measures the time to import the module, to scan the people repo on first use and to reuse the scan, for people
+    repos of different sizes. Each measurement runs in a fresh interpreter."""
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    for num_people in args.people:
+        with tempfile.TemporaryDirectory() as root:
+            people_repo = os.path.join(root, markov.PEOPLE_REPO)
+            os.makedirs(people_repo)
+            for index in range(num_people):
+                open(os.path.join(people_repo, f'person{index}{markov.CHAIN_EXTENSION}'), 'w').close()
+            output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT, module_dir], cwd=root)
+            import_time, scan_time, cached_time = (float(value) * 1000 for value in output.split())
+            print(f'{num_people:>7} people: import {import_time:8.2f} ms, first scan {scan_time:8.2f} ms, '
+                  f'cached {cached_time:6.3f} ms')
+
+
+def bench_overlap(args):
+    """Compares markovify's substring overlap test with the hash and Bloom filter overlap indexes, on sentences walked
+    from the chain, and reports how often each index disagrees with markovify."""
+    rng = random.Random(0)
+    vocabulary = [f'word{i}' for i in range(VOCABULARY_SIZE)]
+    weights = [1 / (rank + 1) for rank in range(VOCABULARY_SIZE)]
+    lines = [' '.join(rng.choices(vocabulary, weights, k=rng.randint(3, 20))) for _ in range(args.messages)]
+    text_model = markovify.NewlineText('\n'.join(lines))
+    walks = [text_model.chain.walk() for _ in range(args.sentences)]
+    expected = [text_model.test_sentence_output(words, markovify.text.DEFAULT_MAX_OVERLAP_RATIO,
+                                                markovify.text.DEFAULT_MAX_OVERLAP_TOTAL) for words in walks]
+
+    def test_all(test):
+        return [test(words, markovify.text.DEFAULT_MAX_OVERLAP_RATIO,
+                     markovify.text.DEFAULT_MAX_OVERLAP_TOTAL) for words in walks]
+
+    def report(label, test, size):
+        disagreements = sum(result != expected_result for result, expected_result in zip(test_all(test), expected))
+        elapsed = time_calls(lambda: test_all(test), args.iterations) * 1000 / len(walks)
+        print(f'{label:>10}: {elapsed:8.2f} us/sentence, {size / 2 ** 20:8.2f} MiB, '
+              f'{disagreements} of {len(walks)} disagree')
+
+    report('substring', text_model.test_sentence_output, len(text_model.rejoined_text))
+    for kind in markov.OVERLAP_KINDS:
+        start = time.perf_counter()
+        index = markov.OverlapIndex.for_model(text_model, kind)
+        print(f'{kind:>10}: built in {(time.perf_counter() - start) * 1000:.0f} ms')
+        report(kind, index.test_sentence_output, len(index.to_bytes()))
+
+
+def bench_load(args):
+    """Load-tests parse_names, generate_markov, generate_fanfic and update_markov_people on a synthetic people repo,
+    reporting latency percentiles, throughput and peak memory for each. Updates use fake Discord messages. Peak memory
+    only covers this process, so it leaves out the workers update_markov_people builds models in."""
+    rng = random.Random(args.seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as repo:
+        start = time.perf_counter()
+        names = build_people(f'{repo}/', args.people, args.messages, args.seed)
+        print(f'Built {len(names)} people in {time.perf_counter() - start:.1f} s')
+        valid_names = markov.get_valid_names()
+        queries = [[name[:rng.randint(3, len(name))] for name in rng.sample(names, min(len(names), 3))]
+                   for _ in range(args.iterations)]
+        inputs = [rng.choice([markov.RANDOM_TAG, markov.ALL_TAG, rng.choice(names)]) for _ in range(args.iterations)]
+
+        def parse_names(index):
+            try:
+                markov.parse_names(queries[index % len(queries)], valid_names)
+            except markov.AmbiguousInputError:
+                pass
+
+        benchmarks = [
+            ('parse_names', parse_names, args.iterations),
+            ('generate_markov', lambda index: markov.generate_markov(inputs[index % len(inputs)], None),
+             args.iterations),
+        ]
+        try:
+            markov.get_fanfic_model()
+        except FileNotFoundError as no_file:
+            print(f'Skipping generate_fanfic: {no_file.filename} not found')
+        else:
+            benchmarks.append(('generate_fanfic', lambda index: markov.generate_fanfic('A', 'B', 'man', 'woman'),
+                               args.fanfic_iterations))
+
+        for label, func, iterations in benchmarks:
+            results[label] = measure(func, iterations, args.concurrency)
+            print_result(label, results[label])
+
+        # New authors join between updates, so both delta appends and new model files are measured.
+        authors = [FakeAuthor(index, name) for index, name in enumerate(names)]
+        batches = []
+        for index in range(args.update_iterations + 5):
+            authors += [FakeAuthor(len(authors), f'newperson{len(authors)}') for _ in range(args.new_authors)]
+            batches.append(fake_messages(rng, authors, args.update_messages))
+        results['update_markov_people'] = measure(lambda index: markov.update_markov_people(batches[index]),
+                                                  args.update_iterations, memory_iterations=1)
+        print_result('update_markov_people', results['update_markov_people'])
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'commit': git_commit(), 'arguments': {key: value for key, value in vars(args).items()
+                                                             if key != 'func'}, 'results': results},
+                      json_file, indent=2)
+
+
+def print_result(label, result):
+    print(f"{label:>20}: p50 {result['p50_ms']:8.2f} ms, p90 {result['p90_ms']:8.2f} ms, "
+          f"p99 {result['p99_ms']:8.2f} ms, {result['throughput_per_s']:8.1f}/s, "
+          f"peak {result['peak_memory_mib']:7.2f} MiB")
+
+
+def git_commit():
+    """Returns the commit the module is checked out at, or None outside a git repository."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def private_memory():
+    """Returns the memory private to this process in MiB, on Linux."""
+    with open('/proc/self/smaps_rollup') as smaps:
+        fields = dict(line.split(':', 1) for line in smaps if ':' in line)
+    return sum(int(fields[field].split()[0]) for field in ('Private_Clean', 'Private_Dirty')) / 1024
+
+
+def shared_worker(repo, shared, names, groups, start_event):
+    """Loads every person and group in one of the bench_shared processes and generates a sentence from each. Returns
+    the time taken in seconds and the memory left private to the process in MiB."""
+    markov.PEOPLE_REPO = repo
+    markov.SHARED_MODELS = shared
+    baseline = private_memory()
+    start_event.wait()
+    start = time.perf_counter()
+    models = [markov.load_person_model(name) for name in names]
+    models += [markov.get_combined_model(group) for group in groups]
+    for model in models:
+        markov.make_sentences(model, 10)
+    return time.perf_counter() - start, private_memory() - baseline
+
+
+def bench_shared(args):
+    """Loads the same people and combined groups in several processes at once, each loading its own copy and then all
+    mapping the people from shared memory segments, and compares the load time and memory private to each process.
+    Combined groups are always built privately from the people. People are written as .json files, the format that
+    can't be shared by mapping the file."""
+    rng = random.Random(0)
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as repo:
+        repo = f'{repo}/'
+        names = [f'person{index}' for index in range(args.people)]
+        for name in names:
+            text_model = markovify.NewlineText('\n'.join(synthetic_lines(rng, args.messages)))
+            with open(f'{repo}{name}{markov.JSON_EXTENSION}', 'w') as json_file:
+                json_file.write(json.dumps(text_model.to_json()))
+        groups = [rng.sample(names, min(len(names), 5)) for _ in range(args.groups)]
+
+        for shared in (False, True):
+            markov.unlink_shared_models()
+            with context.Manager() as manager:
+                start_event = manager.Event()
+                with context.Pool(args.processes) as pool:
+                    results = [pool.apply_async(shared_worker, (repo, shared, names, groups, start_event))
+                               for _ in range(args.processes)]
+                    time.sleep(1)
+                    start_event.set()
+                    results = [result.get() for result in results]
+            times, memory = zip(*results)
+            print(f"{'shared' if shared else 'private':>8}: {args.processes} processes, slowest load {max(times):6.2f} s, "
+                  f"{sum(memory) / len(memory):8.1f} MiB private per process, {sum(memory):8.1f} MiB in total")
+        markov.unlink_shared_models()
+
+
+def check_chain_round_trip(rng, num_messages):
+    """Asserts that packing a model with serialize_chain and reading it back with ChainFile gives the same chain and
+    sentences, for each state size."""
+    for state_size in (1, 2, 3):
+        lines = synthetic_lines(rng, num_messages) + ['caf\u00e9 na\u00efve \u00fcber', 'emoji \U0001f600 word0']
+        text_model = markovify.NewlineText('\n'.join(lines), state_size=state_size)
+        chain_file = markov.ChainFile(markov.serialize_chain(text_model))
+        assert chain_file.to_dict() == text_model.chain.model
+        assert chain_file.sentences().split('\n') == [' '.join(sentence) for sentence in text_model.parsed_sentences]
+
+
+def check_journal_replay(rng, num_messages):
+    """Asserts that replaying an update journal after a crash, and replaying it again, counts every message once. The
+    crash is simulated by writing a person's delta without marking them as done in the journal."""
+    with tempfile.TemporaryDirectory() as repo:
+        names = build_people(f'{repo}/', 2, num_messages, rng.randrange(2 ** 32))
+        people = {name: (synthetic_lines(rng, num_messages), True) for name in names}
+        people['newperson'] = (synthetic_lines(rng, num_messages), False)
+        journal = {'batch': 'check', 'checkpoint': None, 'people': people}
+        markov.write_atomically(markov.update_journal_file(), json.dumps(journal) + '\n')
+        for name, (lines, exists) in people.items():
+            markov.build_person_model(name, lines, exists, journal['batch'])
+        markov.append_line(markov.update_journal_file(), json.dumps({'done': names[0]}))
+
+        assert markov.replay_update_journal() == ([names[1]], ['newperson'])
+        assert markov.replay_update_journal() == ([], [])
+        for name, (lines, exists) in people.items():
+            expected = markovify.NewlineText('\n'.join(lines)).chain.model
+            if exists:
+                path = f'{markov.PEOPLE_REPO}{name}{markov.DELTA_EXTENSION}'
+                assert len(markov.read_lines_written(path)) == 1
+                assert markov.load_delta(path).chain.model == expected
+            else:
+                with open(markov.person_file(name), 'rb') as chain_file:
+                    assert markov.ChainFile(chain_file.read()).to_dict() == expected
+
+
+@contextlib.contextmanager
+def patched(module, **values):
+    """Sets attributes of a module for the body of a with statement, then restores them."""
+    saved = {name: getattr(module, name) for name in values}
+    for name, value in values.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+
+def check_unbuildable_author(rng, num_messages):
+    """Asserts that an author markovify rejects every message of is skipped without leaving the update journal behind,
+    both in an update and when replaying a journal written before a crash, and that later updates still work."""
+    with tempfile.TemporaryDirectory() as repo:
+        names = build_people(f'{repo}/', 1, num_messages, rng.randrange(2 ** 32))
+        start = datetime.datetime(2018, 1, 1)
+        quoter = FakeAuthor(2, 'quoter')
+        messages = fake_messages(rng, [FakeAuthor(1, names[0])], 5)
+        messages += [FakeMessage(quoter, '"only quoted text"', start) for _ in range(markov.MIN_NEW_MESSAGES)]
+        assert markov.update_markov_people(messages).startswith('Corpus successfully updated')
+        assert not os.path.exists(markov.update_journal_file())
+        assert 'quoter' not in markov.get_valid_names()
+
+        journal = {'batch': 'check', 'checkpoint': None, 'carried': [],
+                   'people': {'quoter': (['"only quoted text"'] * markov.MIN_NEW_MESSAGES, False)}}
+        markov.write_atomically(markov.update_journal_file(), json.dumps(journal) + '\n')
+        assert markov.replay_update_journal() == ([], [])
+        assert not os.path.exists(markov.update_journal_file())
+        assert markov.update_markov_people(messages[:5]).startswith('Corpus successfully updated')
+
+
+def check_registry_during_update(rng, num_messages):
+    """Asserts that a person added by an update is in the registry afterwards, even if a lookup rescanned the people
+    repo while the update was writing, and that the registry doesn't need another rescan."""
+
+    class LookingUpExecutor(ProcessPoolExecutor):
+        def submit(self, *args, **kwargs):
+            # Another file in the repo changes, and a command looks a name up before the new person is written.
+            os.utime(markov.PEOPLE_REPO, ns=(0, 0))
+            markov.get_valid_names()
+            return super().submit(*args, **kwargs)
+
+    with tempfile.TemporaryDirectory() as repo:
+        build_people(f'{repo}/', 2, num_messages, rng.randrange(2 ** 32))
+        markov.get_valid_names()
+        with patched(markov, ProcessPoolExecutor=LookingUpExecutor):
+            markov.update_markov_people(fake_messages(rng, [FakeAuthor(3, 'carol')], markov.MIN_NEW_MESSAGES))
+        registry = markov.VALID_NAMES
+        assert 'carol' in registry
+        assert markov.get_valid_names() is registry
+
+
+def check_nested_mixture(rng, num_messages):
+    """Asserts that mixing people, one of whom has a pending delta and so is a mixture too, never combines chains."""
+    def combine(*args, **kwargs):
+        raise AssertionError('markovify.combine was called')
+
+    with tempfile.TemporaryDirectory() as repo:
+        names = build_people(f'{repo}/', 3, num_messages, rng.randrange(2 ** 32))
+        markov.update_markov_people(fake_messages(rng, [FakeAuthor(1, names[0])], 50))
+        with patched(markov, COMBINE_MODE='mixture'):
+            text_model = markov.get_combined_model(names)
+            assert isinstance(text_model.models[0], markov.MixtureText)
+            with patched(markovify, combine=combine):
+                for _ in range(20):
+                    text_model.make_sentence(tries=10)
+
+
+def check_binary_chain_not_kept_as_dict(rng, num_messages):
+    """Asserts that combining people doesn't leave a dict copy of their chains on the cached person models."""
+    with tempfile.TemporaryDirectory() as repo:
+        names = build_people(f'{repo}/', 2, num_messages, rng.randrange(2 ** 32))
+        markov.get_combined_model(names)
+        for name in names:
+            chain = markov.load_person_model(name).chain.source
+            assert isinstance(chain, markov.BinaryChain)
+            assert not any(isinstance(value, dict) for value in vars(chain).values())
+
+
+def check_concurrent_deltas(rng, num_messages):
+    """Asserts that deltas appended for one person from several threads, while others load the person, all land."""
+    with tempfile.TemporaryDirectory() as repo:
+        names = build_people(f'{repo}/', 1, num_messages, rng.randrange(2 ** 32))
+        models = [markovify.NewlineText('\n'.join(synthetic_lines(rng, 20))) for _ in range(16)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            appends = [executor.submit(markov.append_person_delta, names[0], model, f'batch{index}')
+                       for index, model in enumerate(models)]
+            loads = [executor.submit(markov.load_person_model, names[0]) for _ in range(16)]
+            for future in appends + loads:
+                future.result()
+        path = f'{markov.PEOPLE_REPO}{names[0]}{markov.DELTA_EXTENSION}'
+        assert len(markov.read_lines_written(path)) == len(models)
+        expected = markovify.combine([model.chain.model for model in models])
+        assert markov.load_delta(path).chain.model == expected
+
+
+class FakeStatus():
+    """Stands in for the status message an update edits."""
+
+    async def edit(self, content):
+        pass
+
+
+class FakeChannel():
+    """Stands in for a discord.TextChannel whose history is a list of messages, oldest first."""
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    async def history(self, after, limit):
+        for message in self.messages:
+            if message.created_at > after:
+                yield message
+
+
+class FakeContext():
+    """Stands in for the context of an updatemarkov command sent by the module's creator."""
+
+    def __init__(self, channel):
+        self.author = FakeAuthor(markov.get_creator_id(), 'creator')
+        self.channel = channel
+        self.sent = []
+
+    async def send(self, content):
+        self.sent.append(content)
+        return FakeStatus()
+
+
+def run_update_command(messages, fail_on_batch=None):
+    """Runs the updatemarkov command over a fake channel history, optionally failing one of its batches as if the bot
+    had stopped, and returns what the command sent."""
+    real_update_people = markov.update_people
+    batches = [0]
+
+    def update_people(*args):
+        batches[0] += 1
+        if batches[0] == fail_on_batch:
+            raise RuntimeError('update interrupted')
+        return real_update_people(*args)
+
+    async def run():
+        cog = markov.Markov.__new__(markov.Markov)
+        cog.bot = argparse.Namespace(loop=asyncio.get_running_loop())
+        cog.executor = cog.update_executor = ThreadPoolExecutor(max_workers=1)
+        ctx = FakeContext(FakeChannel(messages))
+        await markov.Markov._update.callback(cog, ctx)
+        cog.executor.shutdown()
+        return ctx.sent
+
+    with patched(markov, update_people=update_people), contextlib.redirect_stderr(io.StringIO()):
+        return asyncio.run(run())
+
+
+def written_messages(names):
+    """Returns how many sentences each person's model and delta hold."""
+    counts = {}
+    for name in names:
+        text_model = markov.read_person_files(name)
+        models = text_model.models if isinstance(text_model, markov.MixtureText) else [text_model]
+        counts[name] = sum(len(model.parsed_sentences) for model in models)
+    return counts
+
+
+def check_carried_messages(rng, num_messages):
+    """Asserts that an update interrupted after a batch, then run again, writes the same messages as one that wasn't
+    interrupted, including messages carried between batches, and that a batch with nothing ready is skipped."""
+    authors = [FakeAuthor(10 + index, f'author{index}') for index in range(3)] + \
+              [FakeAuthor(20 + index, f'rare{index}') for index in range(3)]
+    messages = fake_messages(rng, authors[:3], 30)
+    for index, author in enumerate(authors[3:]):
+        # Rare authors post once every ten messages, so they are carried until they have MIN_NEW_MESSAGES.
+        for position in range(index, len(messages), 10):
+            messages[position] = FakeMessage(author, messages[position].content, messages[position].created_at)
+    # A later history of authors who only post once, so no batch of it has anything ready to write.
+    rare_messages = [FakeMessage(FakeAuthor(100 + index, f'once{index}'), content,
+                                 messages[-1].created_at + datetime.timedelta(seconds=index + 1))
+                     for index, content in enumerate(synthetic_lines(rng, 25))]
+
+    results = []
+    for fail_on_batch in (None, 2):
+        with tempfile.TemporaryDirectory() as repo:
+            markov.PEOPLE_REPO = f'{repo}/'
+            markov.VALID_NAMES = None
+            with patched(markov, TIMESTAMP_FILE=f'{repo}/lastupdate.txt', UPDATE_BATCH_SIZE=10):
+                markov.save_timestamp(messages[0].created_at - datetime.timedelta(seconds=1))
+                if fail_on_batch is not None:
+                    sent = run_update_command(messages, fail_on_batch)
+                    assert sent[-1].startswith('Error'), sent
+                    assert len(markov.load_carried_messages()) > 0
+                assert run_update_command(messages)[-1].startswith('Corpus successfully updated')
+                results.append((written_messages(markov.get_valid_names()), markov.load_timestamp()))
+                assert markov.load_carried_messages() == []
+
+                assert run_update_command(rare_messages)[-1].startswith('Corpus successfully updated')
+                assert markov.load_timestamp() == rare_messages[-1].created_at
+    assert results[0] == results[1]
+
+
+def bench_check(args):
+    """Checks correctness rather than speed: the binary chain round trip, replaying update journals, the name registry
+    and storage under concurrent updates, mixtures, and resuming an interrupted updatemarkov command."""
+    rng = random.Random(args.seed)
+    for check in (check_chain_round_trip, check_journal_replay, check_unbuildable_author, check_registry_during_update,
+                  check_nested_mixture, check_binary_chain_not_kept_as_dict, check_concurrent_deltas,
+                  check_carried_messages):
+        check(rng, args.messages)
+        print(f'{check.__name__}: ok')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    combine_parser = subparsers.add_parser('combine', help=bench_combine.__doc__)
+    combine_parser.add_argument('--people', type=int, default=20)
+    combine_parser.add_argument('--messages', type=int, default=2000)
+    combine_parser.add_argument('--group-size', type=int, default=5)
+    combine_parser.add_argument('--groups', type=int, default=4)
+    combine_parser.add_argument('--iterations', type=int, default=50)
+    combine_parser.set_defaults(func=bench_combine)
+
+    sentences_parser = subparsers.add_parser('sentences', help=bench_sentences.__doc__)
+    sentences_parser.add_argument('--sentences', type=int, default=500)
+    sentences_parser.add_argument('--iterations', type=int, default=20)
+    sentences_parser.set_defaults(func=bench_sentences)
+
+    names_parser = subparsers.add_parser('names', help=bench_names.__doc__)
+    names_parser.add_argument('--names', type=int, default=10000)
+    names_parser.add_argument('--queries', type=int, default=100)
+    names_parser.add_argument('--iterations', type=int, default=5)
+    names_parser.set_defaults(func=bench_names)
+
+    startup_parser = subparsers.add_parser('startup', help=bench_startup.__doc__)
+    startup_parser.add_argument('--people', type=int, nargs='+', default=[0, 1000, 10000])
+    startup_parser.set_defaults(func=bench_startup)
+
+    overlap_parser = subparsers.add_parser('overlap', help=bench_overlap.__doc__)
+    overlap_parser.add_argument('--messages', type=int, default=20000)
+    overlap_parser.add_argument('--sentences', type=int, default=1000)
+    overlap_parser.add_argument('--iterations', type=int, default=3)
+    overlap_parser.set_defaults(func=bench_overlap)
+
+    load_parser = subparsers.add_parser('load', help=bench_load.__doc__)
+    load_parser.add_argument('--people', type=int, default=50)
+    load_parser.add_argument('--messages', type=int, default=500)
+    load_parser.add_argument('--iterations', type=int, default=200)
+    load_parser.add_argument('--fanfic-iterations', type=int, default=20)
+    load_parser.add_argument('--update-iterations', type=int, default=3)
+    load_parser.add_argument('--update-messages', type=int, default=5000)
+    load_parser.add_argument('--new-authors', type=int, default=5)
+    load_parser.add_argument('--concurrency', type=int, default=1)
+    load_parser.add_argument('--seed', type=int, default=0)
+    load_parser.add_argument('--json', help='Also write the results to this file.')
+    load_parser.set_defaults(func=bench_load)
+
+    shared_parser = subparsers.add_parser('shared', help=bench_shared.__doc__)
+    shared_parser.add_argument('--processes', type=int, default=4)
+    shared_parser.add_argument('--people', type=int, default=20)
+    shared_parser.add_argument('--messages', type=int, default=5000)
+    shared_parser.add_argument('--groups', type=int, default=5)
+    shared_parser.set_defaults(func=bench_shared)
+
+    check_parser = subparsers.add_parser('check', help=bench_check.__doc__)
+    check_parser.add_argument('--messages', type=int, default=500)
+    check_parser.add_argument('--seed', type=int, default=0)
+    check_parser.set_defaults(func=bench_check)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
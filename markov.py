@@ -3,14 +3,40 @@ to display them."""
 import ujson
 import os
 import random
+import bisect
+import mmap
+import struct
+import sys
 import re
 import string
 import discord
 from discord.ext import commands
-from itertools import product
+from itertools import accumulate
 import markovify
 import datetime
+import functools
+import hashlib
+import contextlib
+import cProfile
+import pstats
+import io
+import time
 import traceback
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from array import array
+from collections import OrderedDict, deque, namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
 
 DEFAULT_NAME = 'MathBot'
 FILTERED_PREFIXES = ('mk', 'rmk', 'markov', '$', '!', '~', '--', 'fanfic', 'listmarkov', 'rlistmarkov')
@@ -32,33 +58,102 @@ MASCULINE_WORDS_FILE = f'{FANFIC_REPO}masculinewords.txt'
 FEMININE_WORDS_FILE = f'{FANFIC_REPO}femininewords.txt'
 CHARACTERS_FILE = f'{FANFIC_REPO}characters.txt'
 COMMON_WORDS_FILE = f'{RESOURCES_REPO}commonwords.txt'
-
-MARKOV_PEOPLE = [f for f in os.listdir(PEOPLE_REPO)]
-VALID_NAMES = [f[:-5] for f in MARKOV_PEOPLE if f.find('.json') != -1]
+FANFIC_CORPUS_FILE = f'{FANFIC_REPO}fanficcorpus.json'
+FANFIC_CHAIN_FILE = f'{FANFIC_REPO}fanficcorpus.chain'
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+JSON_EXTENSION = '.json'
+CHAIN_EXTENSION = '.chain'
+DELTA_EXTENSION = '.delta'
+CHAIN_MAGIC = b'MKCH'
+CHAIN_VERSION = 1
+CHAIN_HEADER = struct.Struct('<4sHHHxxIIIIQ')
+CHAIN_FLAG_TEXT = 1
+NO_STATE = 0xFFFFFFFF
+
+# Generated sentences are tested for overlap with the original text using an OverlapIndex of OVERLAP_INDEX kind,
+# 'hash' or 'bloom', stored next to each model file. None uses markovify's scan of the original text instead.
+OVERLAP_INDEX = 'hash'
+OVERLAP_EXTENSION = '.ngrams'
+OVERLAP_INDEX_MAX_ORDER = markovify.text.DEFAULT_MAX_OVERLAP_TOTAL + 1
+OVERLAP_MAGIC = b'MKNG'
+OVERLAP_VERSION = 1
+OVERLAP_HEADER = struct.Struct('<4sHBBHxxxxxxQ')
+OVERLAP_KINDS = ('hash', 'bloom')
+BLOOM_BITS_PER_GRAM = 16
+BLOOM_HASHES = 11
+GRAM_HASH_MULTIPLIER = 0x100000001B3
+GRAM_HASH_MASK = 0xFFFFFFFFFFFFFFFF
+
+WARM_FANFIC_MODEL = False
+CONSTRAINED_FANFIC_GENERATION = True
+FANFIC_SENTENCE_BATCH_SIZE = 32
+
+# If USE_SENTENCE_POOLS is set, Markov sentences for RANDOM_TAG and ALL_TAG without a root and fanfic paragraphs are
+# generated in the background ahead of time, SENTENCE_POOL_DEPTH per pool, for up to SENTENCE_POOL_MAX_POOLS recently
+# used inputs.
+USE_SENTENCE_POOLS = False
+SENTENCE_POOL_DEPTH = 5
+SENTENCE_POOL_MAX_POOLS = 32
+SENTENCE_POOL_REFILL_INTERVAL = 1
+
+# Generation runs in a pool of EXECUTOR_KIND ('thread' or 'process') workers so it never blocks the event loop.
+# Commands that change the people repo always run one at a time in a separate thread.
+EXECUTOR_KIND = 'thread'
+EXECUTOR_MAX_WORKERS = os.cpu_count() or 1
+MAX_CONCURRENT_GENERATIONS = 4
+GENERATION_TIMEOUT = 30
+UPDATE_MAX_WORKERS = os.cpu_count() or 1
+UPDATE_PROGRESS_INTERVAL = 5
+COMPACTION_INTERVAL = 6 * 60 * 60
+MIN_NEW_MESSAGES = 3
+UPDATE_BATCH_SIZE = 5000
+UPDATE_JOURNAL_FILE_NAME = 'update.journal'
+
+# If SHARED_MODELS is set, every person's model and the fanfic model are loaded once into a shared memory segment and
+# mapped read-only by each bot process on the machine, instead of being loaded into each process's own memory. Combined
+# models are built from the shared people in each process, since every combination of names would need a segment.
+# Needs Python 3.13 or later, whose SharedMemory can be kept out of the resource tracker; older versions load privately.
+SHARED_MODELS = False
+SHARED_MODEL_PREFIX = 'markov_'
+SHARED_MODEL_WAIT = 60
+
+# Number of recent durations kept per stage for `markov stats`.
+STATS_WINDOW = 1000
+
+MODEL_CACHE_MAX_ENTRIES = 64
+MODEL_CACHE_MAX_BYTES = 256 * 1024 * 1024
+COMBINED_CACHE_MAX_ENTRIES = 32
+COMBINED_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# How models of several people are combined: 'cache' merges their chains once per name combination and keeps the
+# result in COMBINED_MODEL_CACHE, 'mixture' samples from the individual models without merging them.
+COMBINE_MODE = 'cache'
+
+# 'compiled' walks chains with the NumPy sampling tables of CompiledChain when NumPy is installed, 'markovify' walks
+# them as stored.
+CHAIN_BACKEND = 'compiled'
+
+
+GENDER_TAG_PATTERN = re.compile(r'\$(?:FE)?MALE\d')
+MENTION_PATTERN = re.compile(r'<@!?(\d+)>')
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+NAME_INDEX_GRAM_LENGTH = 3
 
 MAN_TAGS = ('man', 'male', 'masculine', 'guy', 'boy', 'm')
 WOMAN_TAGS = ('woman', 'female', 'feminine', 'girl', 'f')
 
-with open(MASCULINE_WORDS_FILE, 'r', encoding='utf-8') as f:
-    MASCULINE_WORDS = f.read().splitlines()
-
-with open(FEMININE_WORDS_FILE, 'r', encoding='utf-8') as f:
-    FEMININE_WORDS = f.read().splitlines()
-
-with open(CHARACTERS_FILE, 'r', encoding='utf-8') as f:
-    CHARACTERS = f.read().splitlines()
-
-with open(MARKOV_MODULE_CREATOR_ID_FILE, 'r') as f:
-    MARKOV_MODULE_CREATORS_ID = int(f.readline())
-
 # Below snippet was intended for use with content-aware fanfic generation. See commented-out snippet in
 # generate_fanfic() for more information. If implemented, this snippet must also be uncommented in addition to below.
 #
-# with open(COMMON_WORDS_FILE, 'r') as f:
-#     COMMON_WORDS = f.read().splitlines()
+# @functools.lru_cache(maxsize=None)
+# def get_common_words():
+#     return read_lines(COMMON_WORDS_FILE)
 
 PERMITTED_CHARS = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_-"
 PERMISSION_ERROR_STRING = f'Error: You do not have permission to use this command.'
+TIMEOUT_ERROR_STRING = 'Error: Generation timed out.'
 
 
 class NameNotFoundError(Exception):
@@ -74,16 +169,1645 @@ class AmbiguousInputError(Exception):
         self.output = output
 
 
-def save_timestamp(timestamp):
-    timestamp_string = timestamp.isoformat(' ')
-    with open(TIMESTAMP_FILE, 'w') as f:
-        f.write(timestamp_string)
+class Stats():
+    """In-process timings and counters for the stages of generation and updates. Each stage keeps its last
+    STATS_WINDOW durations, so percentiles follow the recent load. With EXECUTOR_KIND 'process', stages that run in
+    the workers are recorded in the workers and don't show up here.
+
+    If profile_every is set, one in every profile_every calls made through call() runs under cProfile and its profile
+    is added to profile."""
+
+    def __init__(self, window):
+        self.window = window
+        self.durations = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.profile_every = 0
+        self.profile = None
+        self.calls = 0
+
+    def record(self, stage, duration):
+        with self.lock:
+            durations = self.durations.get(stage)
+            if durations is None:
+                durations = self.durations[stage] = deque(maxlen=self.window)
+            durations.append(duration)
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Records how long the body of a with statement takes as one duration of stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def call(self, func, *args):
+        """Calls func, under cProfile if this call is sampled."""
+        with self.lock:
+            self.calls += 1
+            sampled = self.profile_every and self.calls % self.profile_every == 0
+        if not sampled:
+            return func(*args)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args)
+        finally:
+            with self.lock:
+                if self.profile is None:
+                    self.profile = pstats.Stats(profiler)
+                else:
+                    self.profile.add(profiler)
+
+    def set_profiling(self, every):
+        """Samples one in every calls to call() with cProfile, or stops sampling if every is 0. Returns the profile
+        collected so far and starts a new one."""
+        with self.lock:
+            self.profile_every = every
+            profile, self.profile = self.profile, None
+        return profile
+
+    def percentiles(self):
+        """Returns {stage: (count, p50, p90, p99)} with durations in milliseconds."""
+        with self.lock:
+            durations = {stage: sorted(values) for stage, values in self.durations.items()}
+        return {stage: (len(values),) + tuple(values[min(len(values) - 1, int(len(values) * percent))] * 1000
+                                              for percent in (0.5, 0.9, 0.99))
+                for stage, values in durations.items()}
+
+    def rate(self, counter, total_counter):
+        """Returns counter as a fraction of total_counter."""
+        with self.lock:
+            total = self.counters.get(total_counter, 0)
+            return self.counters.get(counter, 0) / total if total else 0.0
+
+    def clear(self):
+        with self.lock:
+            self.durations.clear()
+            self.counters.clear()
+
+
+STATS = Stats(STATS_WINDOW)
+
+
+class NameRegistry():
+    """The names of the people with models, in the order they were added.
+
+    Besides a set for exact lookups, it keeps an index from every substring of up to NAME_INDEX_GRAM_LENGTH characters
+    to the names containing it, so partial names are resolved by intersecting a few sets instead of scanning every
+    name. The index is updated incrementally as names are added and removed."""
+
+    def __init__(self, names=()):
+        self.order = {}
+        self.grams = {}
+        self.next_position = 0
+        self.lock = threading.Lock()
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name):
+        return name in self.order
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.order))
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, name):
+        """Adds a name, keeping its position if it is already present."""
+        with self.lock:
+            if name in self.order:
+                return
+            self.order[name] = self.next_position
+            self.next_position += 1
+            for gram in self._grams(name):
+                self.grams.setdefault(gram, set()).add(name)
+
+    def remove(self, name):
+        """Removes a name. Raises ValueError if it is not present."""
+        with self.lock:
+            if name not in self.order:
+                raise ValueError(name)
+            del self.order[name]
+            for gram in self._grams(name):
+                names = self.grams[gram]
+                names.discard(name)
+                if not names:
+                    del self.grams[gram]
+
+    def choice(self):
+        """Returns a random name."""
+        with self.lock:
+            return random.choice(list(self.order))
+
+    def sample(self, k):
+        """Returns k distinct random names."""
+        with self.lock:
+            return random.sample(list(self.order), k)
+
+    def find(self, name):
+        """Returns [name] if it is a known name, otherwise every name containing it, in the order they were added."""
+        with self.lock:
+            if name in self.order:
+                return [name]
+            if not name:
+                return list(self.order)
+
+            query_grams = {name[i:i + NAME_INDEX_GRAM_LENGTH]
+                           for i in range(max(len(name) - NAME_INDEX_GRAM_LENGTH + 1, 1))}
+            candidates = None
+            for gram in sorted(query_grams, key=lambda gram: len(self.grams.get(gram, ()))):
+                names = self.grams.get(gram)
+                if not names:
+                    return []
+                candidates = set(names) if candidates is None else candidates & names
+            return sorted((candidate for candidate in candidates if name in candidate), key=self.order.get)
+
+    @staticmethod
+    def _grams(name):
+        """Returns every distinct substring of a name with up to NAME_INDEX_GRAM_LENGTH characters."""
+        return {name[i:i + length] for length in range(1, NAME_INDEX_GRAM_LENGTH + 1)
+                for i in range(len(name) - length + 1)}
+
+
+def scan_people(repo):
+    """Returns the names of every person with a model file in repo."""
+    return list(OrderedDict.fromkeys(os.path.splitext(f)[0] for f in os.listdir(repo)
+                                     if f.endswith((JSON_EXTENSION, CHAIN_EXTENSION))))
+
+
+# Resources are only read when first needed, so importing this module doesn't touch the resources directory.
+VALID_NAMES = None
+VALID_NAMES_STAMP = None
+VALID_NAMES_LOCK = threading.Lock()
+
+
+def get_valid_names():
+    """Returns the registry of people with models. The people repo is scanned on first use and again whenever its
+    modification time changes without the change having been made through this module."""
+    global VALID_NAMES, VALID_NAMES_STAMP
+    stamp = os.stat(PEOPLE_REPO).st_mtime_ns
+    with VALID_NAMES_LOCK:
+        if VALID_NAMES is None or stamp != VALID_NAMES_STAMP:
+            VALID_NAMES = NameRegistry(scan_people(PEOPLE_REPO))
+            VALID_NAMES_STAMP = stamp
+        return VALID_NAMES
+
+
+def record_people_change(removed=(), added=()):
+    """Removes and adds names in the registry after this module changed the people repo, and records the repo's
+    modification time so the change doesn't trigger a rescan. The change is made to the current registry under its
+    lock, so it isn't lost if a rescan replaced the registry while the files were being written."""
+    global VALID_NAMES_STAMP
+    with VALID_NAMES_LOCK:
+        if VALID_NAMES is None:
+            return
+        for name in removed:
+            if name in VALID_NAMES:
+                VALID_NAMES.remove(name)
+        for name in added:
+            VALID_NAMES.add(name)
+        VALID_NAMES_STAMP = os.stat(PEOPLE_REPO).st_mtime_ns
+
+
+@contextlib.contextmanager
+def people_scan_kept():
+    """Writes files in the body of a with statement that don't add or remove people, such as overlap indexes, without
+    making the next get_valid_names() rescan. The registry is only kept if it was current before the writes."""
+    stamp = os.stat(PEOPLE_REPO).st_mtime_ns
+    yield
+    global VALID_NAMES_STAMP
+    with VALID_NAMES_LOCK:
+        if VALID_NAMES_STAMP == stamp:
+            VALID_NAMES_STAMP = os.stat(PEOPLE_REPO).st_mtime_ns
+
+
+def read_lines(path):
+    """Returns the lines of a UTF-8 text file."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+@functools.lru_cache(maxsize=None)
+def get_masculine_words():
+    return frozenset(read_lines(MASCULINE_WORDS_FILE))
+
+
+@functools.lru_cache(maxsize=None)
+def get_feminine_words():
+    return frozenset(read_lines(FEMININE_WORDS_FILE))
+
+
+@functools.lru_cache(maxsize=None)
+def get_characters():
+    return read_lines(CHARACTERS_FILE)
+
+
+@functools.lru_cache(maxsize=None)
+def get_creator_id():
+    with open(MARKOV_MODULE_CREATOR_ID_FILE, 'r') as f:
+        return int(f.readline())
+
+
+def save_timestamp(timestamp, carried=()):
+    """Saves the timestamp of the newest message in the corpus, followed by the records of the messages that were
+    carried over to the next update batch, so the checkpoint and the messages it skips are written together."""
+    lines = [timestamp.strftime(TIMESTAMP_FORMAT)] + [ujson.dumps(record) for record in carried]
+    write_atomically(TIMESTAMP_FILE, '\n'.join(lines))
 
 
 def load_timestamp():
     with open(TIMESTAMP_FILE, 'r') as f:
-        timestamp_string = f.readline()
-    return datetime.datetime.strptime(timestamp_string, '%Y-%m-%d %H:%M:%S.%f')
+        timestamp_string = f.readline().rstrip('\n')
+    return datetime.datetime.strptime(timestamp_string, TIMESTAMP_FORMAT)
+
+
+CarriedAuthor = namedtuple('CarriedAuthor', ['id', 'name'])
+CarriedMessage = namedtuple('CarriedMessage', ['author', 'content', 'created_at'])
+
+
+def carried_record(message):
+    """Returns the fields of a message an update reads, in a form that can be saved with the timestamp."""
+    return [message.author.id, message.author.name, message.content, message.created_at.strftime(TIMESTAMP_FORMAT)]
+
+
+def load_carried_messages():
+    """Returns the messages saved with the timestamp that were carried over to the next update batch."""
+    with open(TIMESTAMP_FILE, 'r') as f:
+        records = [ujson.loads(line) for line in f.read().split('\n')[1:] if line]
+    return [CarriedMessage(CarriedAuthor(author_id, author_name), content,
+                           datetime.datetime.strptime(created_at, TIMESTAMP_FORMAT))
+            for author_id, author_name, content, created_at in records]
+
+
+
+class ChainFile():
+    """Read-only view of a Markov chain stored in the compact binary chain format.
+
+    The file consists of a header followed by 8-byte aligned sections:
+        vocabulary offsets  (vocab_count + 1) x uint32, into the vocabulary blob
+        vocabulary blob     UTF-8 words, sorted so that a word can be found with a binary search
+        states              state_count x state_size x uint32 word IDs, sorted by ID
+        state offsets       (state_count + 1) x uint32, into the transition arrays
+        transition words    transition_count x uint32 word IDs
+        transition states   transition_count x uint32 IDs of the state reached by each transition
+        cumulative weights  transition_count x uint32, restarting from zero for each state
+        sentences           UTF-8 text of the original sentences, one per line, if the model retained them
+
+    All integers are little-endian. The buffer is usually an mmap, so opening a chain only maps the file and pages are
+    shared between every process that reads the same file."""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        magic, version, self.state_size, flags, vocab_count, state_count, transition_count, self.begin_state, \
+            text_length = CHAIN_HEADER.unpack_from(buffer, 0)
+        if magic != CHAIN_MAGIC or version != CHAIN_VERSION:
+            raise ValueError('Buffer is not a supported binary chain.')
+        self.has_text = bool(flags & CHAIN_FLAG_TEXT)
+        self.vocab_count = vocab_count
+        self.state_count = state_count
+
+        view = memoryview(buffer)
+        offset = _align(CHAIN_HEADER.size)
+        sections = []
+        for length, typecode in ((4 * (vocab_count + 1), 'I'), (None, None),
+                                 (4 * state_count * self.state_size, 'I'), (4 * (state_count + 1), 'I'),
+                                 (4 * transition_count, 'I'), (4 * transition_count, 'I'),
+                                 (4 * transition_count, 'I'), (text_length, None)):
+            if length is None:
+                length = sections[0][-1]
+            section = view[offset:offset + length]
+            sections.append(section.cast(typecode) if typecode else section)
+            offset = _align(offset + length)
+        self.vocab_offsets, self.vocab_blob, self.states, self.state_offsets, self.transition_words, \
+            self.transition_states, self.cumulative_weights, self.text = sections
+        self.words = {}
+        self.end_id = self.word_id(markovify.chain.END)
+
+    @classmethod
+    def open(cls, path):
+        """Memory-maps the binary chain stored at path."""
+        with open(path, 'rb') as chain_file:
+            return cls(mmap.mmap(chain_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def word(self, word_id):
+        """Returns the word with the given ID."""
+        word = self.words.get(word_id)
+        if word is None:
+            start = self.vocab_offsets[word_id]
+            word = self.words[word_id] = str(self.vocab_blob[start:self.vocab_offsets[word_id + 1]], 'utf-8')
+        return word
+
+    def word_id(self, word):
+        """Returns the ID of a word, or None if it is not in the vocabulary."""
+        target = word.encode('utf-8')
+        low, high = 0, self.vocab_count
+        while low < high:
+            middle = (low + high) // 2
+            current = self.vocab_blob[self.vocab_offsets[middle]:self.vocab_offsets[middle + 1]].tobytes()
+            if current < target:
+                low = middle + 1
+            elif current > target:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def state_words(self, state_id):
+        """Returns the words making up a state."""
+        start = state_id * self.state_size
+        return tuple(self.word(word_id) for word_id in self.states[start:start + self.state_size])
+
+    def state_id(self, state):
+        """Returns the ID of a state given as a tuple of words, or None if the chain never reaches it."""
+        target = []
+        for word in state:
+            word_id = self.word_id(word)
+            if word_id is None:
+                return None
+            target.append(word_id)
+        low, high = 0, self.state_count
+        while low < high:
+            middle = (low + high) // 2
+            start = middle * self.state_size
+            current = self.states[start:start + self.state_size].tolist()
+            if current < target:
+                low = middle + 1
+            elif current > target:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def transitions(self, state_id):
+        """Returns the start and end positions of a state's transitions."""
+        return self.state_offsets[state_id], self.state_offsets[state_id + 1]
+
+    def sample(self, state_id):
+        """Picks a transition out of a state at random and returns its word ID and the ID of the state it reaches."""
+        start, end = self.transitions(state_id)
+        weights = self.cumulative_weights
+        index = bisect.bisect(weights, random.random() * weights[end - 1], start, end)
+        return self.transition_words[index], self.transition_states[index]
+
+    def to_dict(self):
+        """Rebuilds the chain as the dict of dicts used by markovify.Chain."""
+        model = {}
+        for state_id in range(self.state_count):
+            start, end = self.transitions(state_id)
+            options = {}
+            previous = 0
+            for index in range(start, end):
+                options[self.word(self.transition_words[index])] = self.cumulative_weights[index] - previous
+                previous = self.cumulative_weights[index]
+            model[self.state_words(state_id)] = options
+        return model
+
+    def sentences(self):
+        """Returns the text of the original sentences, one per line."""
+        return str(self.text, 'utf-8')
+
+
+def _align(offset):
+    """Rounds an offset up to the next multiple of 8."""
+    return (offset + 7) & ~7
+
+
+def _uint32_array(values):
+    """Packs an iterable of unsigned integers as little-endian uint32s."""
+    packed = array('I', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def serialize_chain(text_model):
+    """Packs a markovify.Text into the binary chain format and returns the bytes."""
+    chain = text_model.chain.model
+    state_size = text_model.state_size
+
+    vocab = set()
+    for state, options in chain.items():
+        vocab.update(state)
+        vocab.update(options)
+    vocab = sorted(vocab)   # Code point order is the same as UTF-8 byte order.
+    word_ids = {word: word_id for word_id, word in enumerate(vocab)}
+
+    states = sorted(chain, key=lambda state: [word_ids[word] for word in state])
+    state_ids = {state: state_id for state_id, state in enumerate(states)}
+
+    state_offsets = [0]
+    transition_words = []
+    transition_states = []
+    cumulative_weights = []
+    for state in states:
+        total = 0
+        for word, count in chain[state].items():
+            total += count
+            if total > 0xFFFFFFFF:
+                raise ValueError('Transition counts are too large for the binary chain format.')
+            transition_words.append(word_ids[word])
+            transition_states.append(state_ids.get(state[1:] + (word,), NO_STATE))
+            cumulative_weights.append(total)
+        state_offsets.append(len(transition_words))
+
+    encoded_words = [word.encode('utf-8') for word in vocab]
+    vocab_offsets = [0]
+    for encoded_word in encoded_words:
+        vocab_offsets.append(vocab_offsets[-1] + len(encoded_word))
+
+    if text_model.retain_original:
+        flags = CHAIN_FLAG_TEXT
+        text = '\n'.join(' '.join(sentence) for sentence in text_model.parsed_sentences).encode('utf-8')
+    else:
+        flags = 0
+        text = b''
+
+    header = CHAIN_HEADER.pack(CHAIN_MAGIC, CHAIN_VERSION, state_size, flags, len(vocab), len(states),
+                               len(transition_words), state_ids[(markovify.chain.BEGIN,) * state_size], len(text))
+    sections = [header, _uint32_array(vocab_offsets), b''.join(encoded_words),
+                _uint32_array(word_ids[word] for state in states for word in state), _uint32_array(state_offsets),
+                _uint32_array(transition_words), _uint32_array(transition_states), _uint32_array(cumulative_weights),
+                text]
+    return b''.join(section + b'\0' * (_align(len(section)) - len(section)) for section in sections)
+
+
+class BinaryChain(markovify.Chain):
+    """A markovify.Chain that walks a ChainFile directly instead of a dict of dicts."""
+
+    def __init__(self, chain_file):
+        self.chain_file = chain_file
+        self.state_size = chain_file.state_size
+
+    @property
+    def model(self):
+        """The chain as a dict of dicts, e.g. for markovify.combine. It is rebuilt on every access rather than kept,
+        so a model served from a mapped file doesn't end up holding a private copy of its whole chain."""
+        return self.chain_file.to_dict()
+
+
+    def precompute_begin_state(self):
+        """The begin state is stored in the file, so there is nothing to precompute."""
+
+    def move(self, state):
+        """Given a state, chooses the next word at random."""
+        state_id = self.chain_file.state_id(state)
+        if state_id is None:
+            raise KeyError(state)
+        return self.chain_file.word(self.chain_file.sample(state_id)[0])
+
+    def gen(self, init_state=None):
+        """Yields successive words until the chain reaches the END state."""
+        chain_file = self.chain_file
+        if init_state is None:
+            state_id = chain_file.begin_state
+        else:
+            state_id = chain_file.state_id(tuple(init_state))
+            if state_id is None:
+                raise KeyError(init_state)
+        while state_id != NO_STATE:
+            word_id, state_id = chain_file.sample(state_id)
+            if word_id == chain_file.end_id:
+                break
+            yield chain_file.word(word_id)
+
+    def states_starting_with(self, words):
+        """Returns every state whose words, ignoring BEGIN, start with the given words."""
+        chain_file = self.chain_file
+        word_ids = []
+        for word in words:
+            word_id = chain_file.word_id(word)
+            if word_id is None:
+                return []
+            word_ids.append(word_id)
+        begin_id = chain_file.word_id(markovify.chain.BEGIN)
+        word_count = len(word_ids)
+        state_size = chain_file.state_size
+        states = chain_file.states
+        matches = []
+        for state_id in range(chain_file.state_count):
+            start = state_id * state_size
+            row = [word_id for word_id in states[start:start + state_size] if word_id != begin_id]
+            if row[:word_count] == word_ids:
+                matches.append(chain_file.state_words(state_id))
+        return matches
+
+
+class BinaryText(markovify.Text):
+    """A markovify.Text backed by a ChainFile. The original sentences are only decoded if overlap checking needs
+    them."""
+
+    def __init__(self, chain_file):
+        self.chain_file = chain_file
+        self.state_size = chain_file.state_size
+        self.retain_original = chain_file.has_text
+        self.chain = BinaryChain(chain_file)
+
+    @functools.cached_property
+    def rejoined_text(self):
+        if not self.retain_original:
+            raise AttributeError('rejoined_text')
+        return self.chain_file.sentences().replace('\n', ' ')
+
+    @property
+    def parsed_sentences(self):
+        if not self.retain_original:
+            raise AttributeError('parsed_sentences')
+        return [line.split(' ') for line in self.chain_file.sentences().split('\n')]
+
+    def make_sentence_with_start(self, beginning, strict=True, **kwargs):
+        """Same as markovify.Text.make_sentence_with_start, but finds non-strict starting states without building the
+        chain's dict."""
+        split = tuple(self.word_split(beginning))
+        if strict or not 0 < len(split) < self.state_size:
+            return super().make_sentence_with_start(beginning, strict, **kwargs)
+        init_states = states_starting_with(self.chain, split)
+        random.shuffle(init_states)
+        for init_state in init_states:
+            output = self.make_sentence(init_state, **kwargs)
+            if output is not None:
+                return output
+        return None
+
+
+class CompiledChain(markovify.Chain):
+    """A markovify.Chain backed by flat NumPy sampling tables, built once when a model is loaded.
+
+    Successor word IDs, the IDs of the states they lead to and each state's running total of transition counts are
+    stored in uint32 arrays ordered by state, the same layout as a ChainFile, so a binary chain's tables are used in
+    place and stay shared between processes. Each step is one bisect on the state's slice of the running total; single
+    steps bisect memoryviews of the arrays, which avoids NumPy's per-call overhead, and walk_many advances many walks
+    at once with a vectorised binary search."""
+
+    def __init__(self, source, words, word_ids, state_ids, offsets, successors, next_states, cumulative_weights):
+        self.source = source
+        self.state_size = source.state_size
+        self.words = words
+        self.word_ids = word_ids
+        self.state_ids = state_ids
+        self.offsets = offsets
+        self.successors = successors
+        self.next_states = next_states
+        self.cumulative_weights = cumulative_weights
+        self.end_id = word_ids(markovify.chain.END)
+        self.begin_state = state_ids((markovify.chain.BEGIN,) * self.state_size)
+        self.rng = numpy.random.default_rng()
+        self.views = tuple(memoryview(table) for table in (offsets, successors, next_states, cumulative_weights))
+
+    @classmethod
+    def from_dict(cls, source):
+        """Compiles a chain whose model is a dict of dicts."""
+        model = source.model
+        words = sorted({word for options in model.values() for word in options} |
+                       {word for state in model for word in state})
+        word_ids = {word: word_id for word_id, word in enumerate(words)}
+        state_ids = {state: state_id for state_id, state in enumerate(model)}
+        offsets = [0]
+        successors = []
+        next_states = []
+        cumulative_weights = []
+        for state, options in model.items():
+            for word, total in zip(options, accumulate(options.values())):
+                successors.append(word_ids[word])
+                next_states.append(state_ids.get(state[1:] + (word,), NO_STATE))
+                cumulative_weights.append(total)
+            offsets.append(len(successors))
+        return cls(source, words.__getitem__, word_ids.get, state_ids.get, numpy.array(offsets, dtype=numpy.uint32),
+                   numpy.array(successors, dtype=numpy.uint32), numpy.array(next_states, dtype=numpy.uint32),
+                   numpy.array(cumulative_weights, dtype=numpy.uint32))
+
+    @classmethod
+    def from_chain_file(cls, source):
+        """Compiles a BinaryChain. Every table is a view of the mapped file, so nothing is copied."""
+        chain_file = source.chain_file
+        return cls(source, chain_file.word, chain_file.word_id, chain_file.state_id,
+                   numpy.frombuffer(chain_file.state_offsets, dtype=numpy.uint32),
+                   numpy.frombuffer(chain_file.transition_words, dtype=numpy.uint32),
+                   numpy.frombuffer(chain_file.transition_states, dtype=numpy.uint32),
+                   numpy.frombuffer(chain_file.cumulative_weights, dtype=numpy.uint32))
+
+    @property
+    def model(self):
+        return self.source.model
+
+    def precompute_begin_state(self):
+        """The sampling tables already cover the begin state."""
+
+    def state_weight(self, state):
+        """Returns the total count of transitions out of a state, or 0 if the chain never reaches it."""
+        state_id = self.state_ids(state)
+        if state_id is None:
+            return 0
+        end = int(self.offsets[state_id + 1])
+        return int(self.cumulative_weights[end - 1]) if end > self.offsets[state_id] else 0
+
+    def step(self, state_id):
+        """Picks a transition out of a state at random and returns its word ID and the ID of the state it reaches."""
+        offsets, successors, next_states, cumulative_weights = self.views
+        start, end = offsets[state_id], offsets[state_id + 1]
+        target = random.random() * cumulative_weights[end - 1]
+        index = bisect.bisect(cumulative_weights, target, start, end)
+        return successors[index], next_states[index]
+
+    def move(self, state):
+        """Given a state, chooses the next word at random."""
+        state_id = self.state_ids(tuple(state))
+        if state_id is None:
+            raise KeyError(state)
+        return self.words(self.step(state_id)[0])
+
+    def gen(self, init_state=None):
+        """Yields successive words until the chain reaches the END state."""
+        state_id = self.begin_state if init_state is None else self.state_ids(tuple(init_state))
+        if state_id is None:
+            raise KeyError(init_state)
+        while state_id != NO_STATE:
+            word_id, state_id = self.step(state_id)
+            if word_id == self.end_id:
+                break
+            yield self.words(word_id)
+
+    def sample_many(self, states):
+        """Picks one transition out of each of an array of states and returns the indices of the transitions. The
+        bisects on each state's slice of the running total are done side by side, one halving per pass."""
+        starts = self.offsets[states].astype(numpy.int64)
+        ends = self.offsets[states + 1].astype(numpy.int64)
+        targets = self.rng.random(len(states)) * self.cumulative_weights[ends - 1]
+        low, high = starts, ends.copy()
+        searching = numpy.flatnonzero(low < high)
+        while len(searching):
+            middle = (low[searching] + high[searching]) // 2
+            right = self.cumulative_weights[middle] <= targets[searching]
+            low[searching] = numpy.where(right, middle + 1, low[searching])
+            high[searching] = numpy.where(right, high[searching], middle)
+            searching = searching[low[searching] < high[searching]]
+        return numpy.minimum(low, ends - 1)
+
+    def walk_many(self, count, init_state=None):
+        """Returns count independent walks, advancing all of them together."""
+        state_id = self.begin_state if init_state is None else self.state_ids(tuple(init_state))
+        if state_id is None:
+            raise KeyError(init_state)
+        states = numpy.full(count, state_id, dtype=numpy.int64)
+        walking = numpy.arange(count)
+        walks = [[] for _ in range(count)]
+        while len(walking):
+            indices = self.sample_many(states[walking])
+            word_ids = self.successors[indices]
+            continuing = (word_ids != self.end_id) & (self.next_states[indices] != NO_STATE)
+            for walk, word_id in zip(walking.tolist(), word_ids.tolist()):
+                if word_id != self.end_id:
+                    walks[walk].append(word_id)
+            states[walking] = self.next_states[indices]
+            walking = walking[continuing]
+        return [[self.words(word_id) for word_id in walk] for walk in walks]
+
+
+def compile_chain(chain):
+    """Returns a CompiledChain for a dict-backed or binary chain, or the chain itself if NumPy is unavailable or
+    CHAIN_BACKEND is not 'compiled'."""
+    if numpy is None or CHAIN_BACKEND != 'compiled' or isinstance(chain, CompiledChain):
+        return chain
+    if isinstance(chain, BinaryChain):
+        return CompiledChain.from_chain_file(chain)
+    if type(chain) is markovify.Chain:
+        return CompiledChain.from_dict(chain)
+    return chain
+
+
+def compile_model(text_model):
+    """Swaps a model's chain for a compiled one, see compile_chain. Returns the model."""
+    text_model.chain = compile_chain(text_model.chain)
+    return text_model
+
+
+def make_sentences(text_model, count, init_state=None, max_overlap_ratio=markovify.text.DEFAULT_MAX_OVERLAP_RATIO,
+                   max_overlap_total=markovify.text.DEFAULT_MAX_OVERLAP_TOTAL):
+    """Makes count sentences in one batch, the way make_sentence makes one, and returns those that pass the model's
+    overlap test. Compiled chains walk the whole batch together."""
+    if init_state is not None:
+        prefix = [word for word in init_state if word != markovify.chain.BEGIN]
+    else:
+        prefix = []
+    if hasattr(text_model.chain, 'walk_many'):
+        walks = text_model.chain.walk_many(count, init_state)
+    else:
+        walks = [text_model.chain.walk(init_state) for _ in range(count)]
+
+    sentences = []
+    for walk in walks:
+        words = prefix + walk
+        if not hasattr(text_model, 'rejoined_text') or \
+                text_model.test_sentence_output(words, max_overlap_ratio, max_overlap_total):
+            sentences.append(text_model.word_join(words))
+    STATS.count('sentences.walked', count)
+    STATS.count('sentences.overlapping', count - len(sentences))
+    return sentences
+
+
+@functools.lru_cache(maxsize=65536)
+def word_hash(word):
+    """Returns a 64-bit hash of a word that is the same in every process, unlike hash()."""
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def gram_hash(words):
+    """Returns the 64-bit hash of a sequence of words, as stored in an OverlapIndex."""
+    value = 0
+    for word in words:
+        value = (value * GRAM_HASH_MULTIPLIER + word_hash(word)) & GRAM_HASH_MASK
+    return (value * GRAM_HASH_MULTIPLIER + len(words)) & GRAM_HASH_MASK
+
+
+def all_gram_hashes(words, max_order):
+    """Returns the sorted, distinct hashes of every run of 1 to max_order consecutive words."""
+    if numpy is None:
+        hashes = set()
+        for start in range(len(words)):
+            value = 0
+            for order, word in enumerate(words[start:start + max_order], 1):
+                value = (value * GRAM_HASH_MULTIPLIER + word_hash(word)) & GRAM_HASH_MASK
+                hashes.add((value * GRAM_HASH_MULTIPLIER + order) & GRAM_HASH_MASK)
+        return sorted(hashes)
+
+    word_hashes = numpy.array([word_hash(word) for word in words], dtype=numpy.uint64)
+    multiplier = numpy.uint64(GRAM_HASH_MULTIPLIER)
+    hashes = []
+    prefixes = numpy.zeros(len(word_hashes) + 1, dtype=numpy.uint64)
+    with numpy.errstate(over='ignore'):
+        for order in range(1, min(max_order, len(word_hashes)) + 1):
+            prefixes = prefixes[:len(word_hashes) - order + 1] * multiplier + word_hashes[order - 1:]
+            hashes.append(prefixes * multiplier + numpy.uint64(order))
+    if not hashes:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    return numpy.unique(numpy.concatenate(hashes))
+
+
+class OverlapIndex():
+    """Hashes of every run of up to max_order consecutive words in a model's original text, used to test generated
+    sentences for overlap without scanning the text.
+
+    A 'hash' index stores the sorted hashes and is exact up to hash collisions. A 'bloom' index stores a Bloom filter
+    of BLOOM_BITS_PER_GRAM bits per hash, which is several times smaller but occasionally reports a run that isn't in
+    the text, rejecting a sentence markovify would have accepted. Either is serialized as a header followed by the table,
+    and opened with mmap.
+
+    Unlike markovify's substring check, runs are matched on whole words, so a run that only appears in the text as part
+    of longer words doesn't count as overlap."""
+
+    def __init__(self, kind, num_hashes, max_order, size, table, buffer=None):
+        self.kind = kind
+        self.num_hashes = num_hashes
+        self.max_order = max_order
+        self.size = size
+        self.table = table
+        self.buffer = buffer
+
+    @classmethod
+    def build(cls, words, kind, max_order=None):
+        """Indexes a list of words, the model's sentences in order."""
+        if max_order is None:
+            max_order = OVERLAP_INDEX_MAX_ORDER
+        hashes = all_gram_hashes(words, max_order)
+        if kind == 'hash':
+            return cls(kind, 0, max_order, len(hashes), memoryview(_uint64_array(hashes)).cast('Q'))
+
+        num_bits = max(64, (len(hashes) * BLOOM_BITS_PER_GRAM + 63) // 64 * 64)
+        if numpy is None:
+            bits = bytearray(num_bits // 8)
+            for value in hashes:
+                for position in cls._bloom_positions(value, BLOOM_HASHES, num_bits):
+                    bits[position >> 3] |= 1 << (position & 7)
+        else:
+            hashes = numpy.asarray(hashes, dtype=numpy.uint64)
+            low = hashes & numpy.uint64(0xFFFFFFFF)
+            high = (hashes >> numpy.uint64(32)) | numpy.uint64(1)
+            bits = numpy.zeros(num_bits // 8, dtype=numpy.uint8)
+            with numpy.errstate(over='ignore'):
+                for i in range(BLOOM_HASHES):
+                    positions = (low + numpy.uint64(i) * high) % numpy.uint64(num_bits)
+                    numpy.bitwise_or.at(bits, positions >> numpy.uint64(3),
+                                        numpy.left_shift(1, positions & numpy.uint64(7)).astype(numpy.uint8))
+            bits = bytearray(bits.tobytes())
+        return cls(kind, BLOOM_HASHES, max_order, num_bits, memoryview(bits))
+
+    @classmethod
+    def for_model(cls, text_model, kind):
+        """Indexes the original text of a model, or returns None if it didn't keep it."""
+        if not text_model.retain_original:
+            return None
+        if isinstance(text_model, BinaryText):
+            words = text_model.chain_file.sentences().replace('\n', ' ').split(' ')
+        else:
+            words = [word for sentence in text_model.parsed_sentences for word in sentence]
+        return cls.build(words, kind)
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        magic, version, kind, num_hashes, max_order, size = OVERLAP_HEADER.unpack_from(buffer, 0)
+        if magic != OVERLAP_MAGIC or version != OVERLAP_VERSION:
+            raise ValueError('Buffer is not a supported overlap index.')
+        table = memoryview(buffer)[OVERLAP_HEADER.size:]
+        if kind == OVERLAP_KINDS.index('hash'):
+            table = table[:8 * size].cast('Q')
+        return cls(OVERLAP_KINDS[kind], num_hashes, max_order, size, table, buffer)
+
+    @classmethod
+    def open(cls, path):
+        """Memory-maps the index stored at path."""
+        with open(path, 'rb') as index_file:
+            return cls.from_buffer(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def to_bytes(self):
+        header = OVERLAP_HEADER.pack(OVERLAP_MAGIC, OVERLAP_VERSION, OVERLAP_KINDS.index(self.kind), self.num_hashes,
+                                     self.max_order, self.size)
+        return header + self.table.tobytes()
+
+    def save(self, path):
+        """Writes the index under a temporary name and moves it into place."""
+        write_atomically(path, self.to_bytes())
+
+    @staticmethod
+    def _bloom_positions(value, num_hashes, num_bits):
+        low = value & 0xFFFFFFFF
+        high = (value >> 32) | 1
+        return [((low + i * high) & GRAM_HASH_MASK) % num_bits for i in range(num_hashes)]
+
+    def __contains__(self, words):
+        """Returns whether a run of words appears in the indexed text."""
+        value = gram_hash(words[:self.max_order])
+        if self.kind == 'hash':
+            index = bisect.bisect_left(self.table, value)
+            return index < self.size and self.table[index] == value
+        return all(self.table[position >> 3] & (1 << (position & 7))
+                   for position in self._bloom_positions(value, self.num_hashes, self.size))
+
+    def test_sentence_output(self, words, max_overlap_ratio, max_overlap_total):
+        """Same test as markovify.Text.test_sentence_output, using the index. Runs longer than max_order are tested
+        by their first max_order words, which can only reject more sentences."""
+        overlap_ratio = int(round(max_overlap_ratio * len(words)))
+        overlap_max = min(max_overlap_total, overlap_ratio)
+        overlap_over = overlap_max + 1
+        gram_count = max((len(words) - overlap_max), 1)
+        for i in range(gram_count):
+            if words[i:i + overlap_over] in self:
+                return False
+        return True
+
+
+class CombinedOverlapIndex():
+    """Overlap test for a combined model: a sentence passes only if it passes for every component."""
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def test_sentence_output(self, words, max_overlap_ratio, max_overlap_total):
+        return all(index.test_sentence_output(words, max_overlap_ratio, max_overlap_total) for index in self.indexes)
+
+
+def _uint64_array(values):
+    """Packs an iterable of unsigned integers as little-endian uint64s."""
+    if numpy is not None:
+        return numpy.asarray(values, dtype='<u8').tobytes()
+    packed = array('Q', [int(value) for value in values])
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def attach_overlap_index(text_model, index):
+    """Makes a model test generated sentences with an overlap index instead of scanning its original text, which is
+    then no longer kept in memory. Returns the model."""
+    if index is None:
+        return text_model
+    text_model.overlap_index = index
+    return delegate_overlap_test(text_model, index.test_sentence_output)
+
+
+def delegate_overlap_test(text_model, test=None):
+    """Makes markovify test a model's sentences for overlap with test(words, max_overlap_ratio, max_overlap_total), or
+    with the model's own test_sentence_output if test is None, instead of searching its original text. markovify only
+    runs the test if the model has a rejoined_text attribute, so it is set to None, which also lets the text go.
+    Returns the model."""
+    if test is not None:
+        text_model.test_sentence_output = test
+    text_model.rejoined_text = None
+    return text_model
+
+
+def load_overlap_index(text_model, model_path):
+    """Attaches the overlap index stored next to a model file, building and saving it first if it is missing or older
+    than the model. Does nothing if OVERLAP_INDEX is None. Returns the model."""
+    if OVERLAP_INDEX is None or not text_model.retain_original:
+        return text_model
+    index_path = f'{os.path.splitext(model_path)[0]}{OVERLAP_EXTENSION}'
+    try:
+        if os.stat(index_path).st_mtime_ns >= os.stat(model_path).st_mtime_ns:
+            index = OverlapIndex.open(index_path)
+            if index.kind == OVERLAP_INDEX:
+                return attach_overlap_index(text_model, index)
+    except (FileNotFoundError, ValueError):
+        pass
+    index = OverlapIndex.for_model(text_model, OVERLAP_INDEX)
+    with people_scan_kept():
+        index.save(index_path)
+    return attach_overlap_index(text_model, index)
+
+
+class ModelCache():
+    """Process-wide LRU cache of deserialized Markov models.
+
+    Entries are keyed by file path and bounded both by count and by approximate memory, which is estimated from the
+    size of the file on disk. An entry is reloaded whenever the modification time or size of its file changes."""
+
+    def __init__(self, max_entries=MODEL_CACHE_MAX_ENTRIES, max_bytes=MODEL_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, loader):
+        """Returns the model stored at path, calling loader(path) only if it is not cached or is out of date."""
+        stamp = file_stamp(path)
+        return self.get_keyed(path, stamp, stamp[1], lambda: loader(path))
+
+    def get_keyed(self, key, stamp, size, builder):
+        """Returns the model cached under key if it was stored with the same stamp, otherwise calls builder() and
+        caches its result with an approximate size of size bytes. The builder runs without holding the lock, so two
+        threads missing on the same key at once may both build it."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+
+        model = builder()
+        with self.lock:
+            self._remove(key)
+            self.entries[key] = (stamp, size, model)
+            self.total_bytes += size
+            self._evict()
+        return model
+
+    def invalidate(self, path):
+        """Drops the entry for path, if any."""
+        with self.lock:
+            self._remove(path)
+
+    def clear(self):
+        """Drops every entry."""
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """Returns a dict of the cache's size and hit/miss/eviction counters."""
+        return {
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def _evict(self):
+        """Removes least recently used entries until the cache is within its bounds. The newest entry is always kept."""
+        while len(self.entries) > 1 and \
+                (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            _, (_, size, _) = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+
+
+MODEL_CACHE = ModelCache()
+COMBINED_MODEL_CACHE = ModelCache(COMBINED_CACHE_MAX_ENTRIES, COMBINED_CACHE_MAX_BYTES)
+
+
+def file_stamp(path):
+    """Returns the modification time and size of a file, which together identify a version of a model."""
+    file_stat = os.stat(path)
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+
+class ReadWriteLock():
+    """Lets any number of threads read, or one thread write. Waiting writers keep new readers out, so a steady stream
+    of reads can't starve them. The writing thread may take the lock again, to read or write, but reads don't nest."""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = None
+        self.writer_depth = 0
+        self.waiting_writers = 0
+
+    @contextlib.contextmanager
+    def reading(self):
+        if self.writer == threading.get_ident():
+            with self.writing():
+                yield
+            return
+        with self.condition:
+            while self.writer is not None or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        thread = threading.get_ident()
+        with self.condition:
+            if self.writer != thread:
+                self.waiting_writers += 1
+                while self.writer is not None or self.readers:
+                    self.condition.wait()
+                self.waiting_writers -= 1
+                self.writer = thread
+            self.writer_depth += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer_depth -= 1
+                if self.writer_depth == 0:
+                    self.writer = None
+                    self.condition.notify_all()
+
+
+class PersonLocks():
+    """One ReadWriteLock per person, so reading a person's files only waits for writes to that person."""
+
+    def __init__(self):
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            lock = self.locks.get(name)
+            if lock is None:
+                lock = self.locks[name] = ReadWriteLock()
+            return lock
+
+    def reading(self, name):
+        return self.get(name).reading()
+
+    @contextlib.contextmanager
+    def writing(self, *names):
+        """Write-locks every given person, always in the same order so that two writers can't deadlock."""
+        with contextlib.ExitStack() as stack:
+            for name in sorted(set(names)):
+                stack.enter_context(self.get(name).writing())
+            yield
+
+
+PERSON_LOCKS = PersonLocks()
+
+
+def write_atomically(path, data):
+    """Writes bytes or text to a file under a temporary name, flushes it to disk and moves it into place, so readers
+    see either the old file or the complete new one, and a crash never leaves a partial file behind."""
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temp_path, 'wb') as temp_file:
+            temp_file.write(data.encode('utf-8') if isinstance(data, str) else data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def append_line(path, line):
+    """Appends a line to a file in a single write and flushes it to disk. A crash can only leave the last line
+    incomplete, and read_lines_written skips it."""
+    with open(path, 'ab') as append_file:
+        append_file.write(line.encode('utf-8') + b'\n')
+        append_file.flush()
+        os.fsync(append_file.fileno())
+
+
+def read_lines_written(path):
+    """Returns the complete lines of a file written by append_line, leaving out a last line that was cut off."""
+    with open(path, 'r', encoding='utf-8') as lines_file:
+        lines = lines_file.read().split('\n')
+    return [line for line in lines[:-1] if line]
+
+
+def read_last_line_written(path):
+    """Returns the last complete line of a file written by append_line, or None if it has none. The file is read
+    backwards from the end in growing chunks, so only the tail is read however long the file is."""
+    with open(path, 'rb') as lines_file:
+        position = lines_file.seek(0, os.SEEK_END)
+        tail = b''
+        while position > 0:
+            size = min(max(len(tail), 64 * 1024), position)
+            position -= size
+            lines_file.seek(position)
+            tail = lines_file.read(size) + tail
+            lines = tail[:tail.rfind(b'\n') + 1].split(b'\n')[:-1]
+            # Unless the start of the file has been reached, the first line may be cut off by the chunk.
+            complete = [line for line in (lines if position == 0 else lines[1:]) if line]
+            if complete:
+                return complete[-1].decode('utf-8')
+    return None
+
+
+def person_file(name):
+    """Returns the path of the model file for the given person, preferring the binary format if both exist."""
+    chain_path = f'{PEOPLE_REPO}{name}{CHAIN_EXTENSION}'
+    if os.path.exists(chain_path):
+        return chain_path
+    return f'{PEOPLE_REPO}{name}{JSON_EXTENSION}'
+
+
+def invalidate_person(name):
+    """Drops a person's model from the model cache after its file has been rewritten or removed."""
+    for extension in (JSON_EXTENSION, CHAIN_EXTENSION):
+        MODEL_CACHE.invalidate(f'{PEOPLE_REPO}{name}{extension}')
+
+
+def load_model(path):
+    """Deserializes a Markov model from a .json or binary .chain file."""
+    if path.endswith(CHAIN_EXTENSION):
+        return BinaryText(ChainFile.open(path))
+    with open(path, 'r', encoding='utf-8-sig') as json_file:
+        return markovify.Text.from_json(ujson.load(json_file))
+
+
+def person_stamp(name):
+    """Returns the stamps of a person's model file and delta file, which together identify a version of their model,
+    and their total size."""
+    base_stamp = file_stamp(person_file(name))
+    delta_path = f'{PEOPLE_REPO}{name}{DELTA_EXTENSION}'
+    delta_stamp = file_stamp(delta_path) if os.path.exists(delta_path) else (0, 0)
+    return (base_stamp, delta_stamp), base_stamp[1] + delta_stamp[1]
+
+
+def load_person_model(name):
+    """Returns the (cached) model for the given person, including any updates still in their delta file."""
+    stamp, size = person_stamp(name)
+
+    def load():
+        with STATS.timer('models.load'):
+            if SHARED_MODELS:
+                return load_shared_model(('person', name), stamp, lambda: load_person_files(name))
+            return load_person_files(name)
+    return MODEL_CACHE.get_keyed(person_file(name), stamp, size, load)
+
+
+def load_person_files(name):
+    """Loads a person's model file and folds in their delta file, if they have one."""
+    with PERSON_LOCKS.reading(name):
+        return read_person_files(name)
+
+
+def read_person_files(name):
+    """Same as load_person_files, for callers that already hold the person's lock."""
+    path = person_file(name)
+    model = load_overlap_index(compile_model(load_model(path)), path)
+    delta_model = load_delta(f'{PEOPLE_REPO}{name}{DELTA_EXTENSION}')
+    if delta_model is None:
+        return model
+    if OVERLAP_INDEX is not None:
+        attach_overlap_index(delta_model, OverlapIndex.for_model(delta_model, OVERLAP_INDEX))
+    return MixtureText([model, compile_model(delta_model)])
+
+
+def append_person_delta(name, text_model, batch=None):
+    """Records the transition counts and sentences of a model built from new messages in the person's append-only
+    delta file, so an update never rewrites the person's whole model. Deltas are merged into the model file by
+    compact_person.
+
+    If batch is given, it is stored with the delta, and the delta isn't appended again if the last one came from the
+    same batch, so replaying an update journal doesn't count messages twice."""
+    path = f'{PEOPLE_REPO}{name}{DELTA_EXTENSION}'
+    delta = {
+        'state_size': text_model.state_size,
+        'chain': list(text_model.chain.model.items()),
+        'parsed_sentences': text_model.parsed_sentences if text_model.retain_original else [],
+        'batch': batch
+    }
+    with PERSON_LOCKS.writing(name):
+        if batch is not None and os.path.exists(path):
+            last_line = read_last_line_written(path)
+            if last_line is not None and ujson.loads(last_line).get('batch') == batch:
+                return
+        append_line(path, ujson.dumps(delta))
+        invalidate_person(name)
+
+
+def load_delta(path):
+    """Sums every delta in a delta file into one model, or returns None if there is no delta file."""
+    try:
+        lines = read_lines_written(path)
+    except FileNotFoundError:
+        return None
+
+    chain = {}
+    parsed_sentences = []
+    state_size = None
+    for line in lines:
+        delta = ujson.loads(line)
+        state_size = delta['state_size']
+        parsed_sentences += delta['parsed_sentences']
+        for state, options in delta['chain']:
+            current = chain.setdefault(tuple(state), {})
+            for word, count in options.items():
+                current[word] = current.get(word, 0) + count
+    if not chain:
+        return None
+    return markovify.Text(None, state_size=state_size, chain=markovify.Chain(None, state_size, chain),
+                          parsed_sentences=parsed_sentences or None)
+
+
+def compact_person(name):
+    """Merges a person's delta file into their model file."""
+    with PERSON_LOCKS.writing(name):
+        if not os.path.exists(f'{PEOPLE_REPO}{name}{DELTA_EXTENSION}'):
+            return
+        model = read_person_files(name)
+        if isinstance(model, MixtureText):
+            model = combine_models(model.models)
+        save_person_model(name, model)
+
+
+def compact_people():
+    """Merges every pending delta file into its model file. Returns the number of people compacted."""
+    names = [file_name[:-len(DELTA_EXTENSION)] for file_name in os.listdir(PEOPLE_REPO)
+             if file_name.endswith(DELTA_EXTENSION)]
+    for name in names:
+        compact_person(name)
+    return len(names)
+
+
+def write_chain_file(path, text_model):
+    """Writes a model in the binary chain format. The file is written under a temporary name and then moved into
+    place, so processes that have the old file memory-mapped keep reading it intact."""
+    write_atomically(path, serialize_chain(text_model))
+
+
+def save_person_model(name, text_model):
+    """Writes a person's whole model in the binary chain format, replacing any .json or delta file they had. Its
+    overlap index is written alongside it."""
+    with PERSON_LOCKS.writing(name):
+        write_chain_file(f'{PEOPLE_REPO}{name}{CHAIN_EXTENSION}', text_model)
+        for extension in (JSON_EXTENSION, DELTA_EXTENSION, OVERLAP_EXTENSION):
+            if os.path.exists(f'{PEOPLE_REPO}{name}{extension}'):
+                os.remove(f'{PEOPLE_REPO}{name}{extension}')
+        if OVERLAP_INDEX is not None and text_model.retain_original:
+            OverlapIndex.for_model(text_model, OVERLAP_INDEX).save(f'{PEOPLE_REPO}{name}{OVERLAP_EXTENSION}')
+        invalidate_person(name)
+
+
+def remove_person_model(name):
+    """Deletes every model, delta and overlap index file belonging to the given person."""
+    with PERSON_LOCKS.writing(name):
+        for extension in (JSON_EXTENSION, CHAIN_EXTENSION, DELTA_EXTENSION, OVERLAP_EXTENSION):
+            if os.path.exists(f'{PEOPLE_REPO}{name}{extension}'):
+                os.remove(f'{PEOPLE_REPO}{name}{extension}')
+        invalidate_person(name)
+
+
+def rename_person_model(before_name, after_name):
+    """Moves a person's model, delta and overlap index files to a new name, keeping their format."""
+    with PERSON_LOCKS.writing(before_name, after_name):
+        before_path = person_file(before_name)
+        extension = os.path.splitext(before_path)[1]
+        remove_person_model(after_name)
+        os.replace(before_path, f'{PEOPLE_REPO}{after_name}{extension}')
+        for extension in (DELTA_EXTENSION, OVERLAP_EXTENSION):
+            if os.path.exists(f'{PEOPLE_REPO}{before_name}{extension}'):
+                os.replace(f'{PEOPLE_REPO}{before_name}{extension}', f'{PEOPLE_REPO}{after_name}{extension}')
+        invalidate_person(before_name)
+
+
+def combine_models(models):
+    """Combines models of any storage format into one markovify.Text."""
+    if len(models) == 1:
+        return models[0]
+    state_size = models[0].state_size
+    with STATS.timer('models.combine'):
+        chain = markovify.combine([model.chain.model for model in models])
+    parsed_sentences = []
+    indexes = []
+    for model in models:
+        for component in getattr(model, 'models', [model]):
+            if component.retain_original:
+                parsed_sentences += component.parsed_sentences
+                indexes.append(getattr(component, 'overlap_index', None))
+    with STATS.timer('models.compile'):
+        combined_model = compile_model(markovify.Text(None, state_size=state_size,
+                                                      chain=markovify.Chain(None, state_size, chain),
+                                                      parsed_sentences=parsed_sentences or None))
+    if indexes and None not in indexes:
+        attach_overlap_index(combined_model, CombinedOverlapIndex(indexes))
+    return combined_model
+
+
+def get_combined_model(names):
+    """Returns a single model generating text for every person in names, combined according to COMBINE_MODE."""
+    if len(names) == 1:
+        return load_person_model(names[0])
+    if COMBINE_MODE == 'mixture':
+        return MixtureText(generate_models(PEOPLE_REPO, names))
+
+    names = tuple(sorted(names))
+    try:
+        stamps = [person_stamp(name) for name in names]
+    except FileNotFoundError:
+        raise FileNotFoundError()
+    stamp = tuple(stamp for stamp, _ in stamps)
+    return COMBINED_MODEL_CACHE.get_keyed(names, stamp, sum(size for _, size in stamps),
+                                          lambda: combine_models(generate_models(PEOPLE_REPO, names)))
+
+
+def open_shared_memory(name, size=0):
+    """Creates a shared memory segment of size bytes, or attaches to an existing one if size is 0. The segment is kept
+    out of the resource tracker, so it outlives the process that created it and can be shared between bot processes
+    started independently. Needs SharedMemory's track argument, added in Python 3.13."""
+    return shared_memory.SharedMemory(name, create=size > 0, size=size, track=False)
+
+
+def map_segment(segment):
+    """Maps a shared memory segment read-only and closes the segment object. Models keep the mapping instead of the
+    segment, which can't be closed while the model's tables still point into it."""
+    if os.name == 'nt':
+        buffer = mmap.mmap(-1, segment.size, tagname=segment.name, access=mmap.ACCESS_READ)
+    else:
+        buffer = mmap.mmap(segment._fd, segment.size, access=mmap.ACCESS_READ)
+    segment.close()
+    return buffer
+
+
+def unlink_segment(segment):
+    """Removes a shared memory segment opened with open_shared_memory."""
+    segment.unlink()
+    segment.close()
+
+
+def wait_for_segment(name, deadline):
+    """Attaches to the segment called name once it exists and its magic has been written."""
+    while True:
+        try:
+            segment = open_shared_memory(name)
+        except (FileNotFoundError, ValueError):
+            # ValueError means the segment has been created but not sized yet.
+            segment = None
+        if segment is not None and segment.buf[:4] != bytes(4):
+            return segment
+        if segment is not None:
+            segment.close()
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'Shared memory segment {name} was never completed.')
+        time.sleep(0.01)
+
+
+def shared_segment(name, build):
+    """Returns the shared memory segment called name, creating it with the bytes returned by build() if no process
+    has yet. The process that builds a segment first claims it with a marker segment, so the others wait for it instead
+    of building it too. The segment starts with a 4-byte magic, which is written last, so readers never see a partly
+    written segment. Raises TimeoutError if the segment isn't ready within SHARED_MODEL_WAIT seconds."""
+    try:
+        segment = open_shared_memory(name)
+    except (FileNotFoundError, ValueError):
+        pass
+    else:
+        if segment.buf[:4] != bytes(4):
+            return segment
+        segment.close()
+
+    deadline = time.monotonic() + SHARED_MODEL_WAIT
+    try:
+        claim = open_shared_memory(f'{name}_', 1)
+    except FileExistsError:
+        try:
+            return wait_for_segment(name, deadline)
+        except TimeoutError:
+            # The process that claimed the segment is gone, so let the next attempt claim it again.
+            unlink_shared_segment(f'{name}_')
+            raise
+
+    try:
+        data = build()
+        try:
+            segment = open_shared_memory(name, len(data))
+        except FileExistsError:
+            # Another process finished the segment and dropped its claim between the first attach and this claim.
+            return wait_for_segment(name, deadline)
+        segment.buf[4:len(data)] = data[4:]
+        segment.buf[:4] = data[:4]
+        return segment
+    finally:
+        unlink_segment(claim)
+
+
+def shared_segment_name(key, stamp):
+    """Returns the name of the segment holding a version of a model. Every process derives the same name from the
+    model's key and the stamp of its files, so a changed model gets a new segment."""
+    digest = hashlib.blake2b(repr((key, stamp)).encode('utf-8'), digest_size=10).hexdigest()
+    return f'{SHARED_MODEL_PREFIX}{digest}'
+
+
+def load_shared_model(key, stamp, builder):
+    """Returns the model identified by key and stamp, served from shared memory. The first process to ask for it builds
+    it with builder() and writes it in the binary chain format, along with its overlap index; every other process maps
+    the same pages read-only. Falls back to builder() if the segment can't be used, or if this Python's SharedMemory
+    can't be kept out of the resource tracker."""
+    if not SHARED_MEMORY_SUPPORTED:
+        return builder()
+    name = shared_segment_name(key, stamp)
+    try:
+        chain_segment = shared_segment(f'{name}c', lambda: model_bytes(builder()))
+    except FileNotFoundError:
+        raise
+    except (OSError, TimeoutError):
+        traceback.print_exc()
+        return builder()
+
+    text_model = compile_model(BinaryText(ChainFile(map_segment(chain_segment))))
+    if OVERLAP_INDEX is not None and text_model.retain_original:
+        try:
+            index_segment = shared_segment(f'{name}n', lambda: OverlapIndex.for_model(text_model,
+                                                                                       OVERLAP_INDEX).to_bytes())
+        except (OSError, TimeoutError):
+            traceback.print_exc()
+        else:
+            attach_overlap_index(text_model, OverlapIndex.from_buffer(map_segment(index_segment)))
+
+    previous_name = SHARED_MODEL_NAMES.get(key)
+    SHARED_MODEL_NAMES[key] = name
+    if previous_name is not None and previous_name != name:
+        unlink_shared_model(previous_name)
+    return text_model
+
+
+def model_bytes(text_model):
+    """Returns a model in the binary chain format, combining a model and its delta first if needed."""
+    if isinstance(text_model, MixtureText):
+        text_model = combine_models(text_model.models)
+    if isinstance(text_model, BinaryText):
+        return bytes(text_model.chain_file.buffer)
+    return serialize_chain(text_model)
+
+
+def unlink_shared_model(name):
+    """Removes the segments of an old version of a model. Processes that still map them keep their pages until they
+    let go of the model."""
+    for suffix in ('c', 'n'):
+        unlink_shared_segment(f'{name}{suffix}')
+
+
+def unlink_shared_segment(name):
+    """Removes the segment called name, if it exists."""
+    try:
+        unlink_segment(open_shared_memory(name))
+    except FileNotFoundError:
+        pass
+
+
+def unlink_shared_models():
+    """Removes every model segment from shared memory, e.g. once every bot process has stopped. Returns how many there
+    were. Only supported where segments are listed in /dev/shm, as on Linux."""
+    if not SHARED_MEMORY_SUPPORTED:
+        return 0
+    names = [name for name in os.listdir('/dev/shm') if name.startswith(SHARED_MODEL_PREFIX)]
+    for name in names:
+        unlink_shared_segment(name)
+    SHARED_MODEL_NAMES.clear()
+    return len(names)
+
+
+SHARED_MODEL_NAMES = {}
+SHARED_MEMORY_SUPPORTED = shared_memory is not None and \
+    'track' in shared_memory.SharedMemory.__init__.__code__.co_varnames
+
+
+def state_weight(chain, state):
+    """Returns the total count of transitions out of a state, or 0 if the chain never reaches it."""
+    if isinstance(chain, CompiledChain):
+        return chain.state_weight(state)
+    if isinstance(chain, BinaryChain):
+        state_id = chain.chain_file.state_id(state)
+        if state_id is None:
+            return 0
+        return chain.chain_file.cumulative_weights[chain.chain_file.transitions(state_id)[1] - 1]
+    if isinstance(chain, MixtureChain):
+        return sum(state_weight(component, state) for component in chain.chains)
+    options = chain.model.get(state)
+
+    if options is None:
+        return 0
+    return sum(options.values())
+
+
+def states_starting_with(chain, words):
+    """Returns every state of a chain whose words, ignoring BEGIN, start with the given words."""
+    if isinstance(chain, CompiledChain):
+        chain = chain.source
+    if isinstance(chain, BinaryChain):
+        return chain.states_starting_with(words)
+    word_count = len(words)
+    return [state for state in chain.model
+            if tuple(word for word in state if word != markovify.chain.BEGIN)[:word_count] == words]
+
+
+class MixtureChain(markovify.Chain):
+    """A markovify.Chain that samples from several chains as if they had been combined, without merging them.
+
+    At each step one component is picked with probability proportional to its number of transitions out of the
+    current state, and then moves on its own. This gives the same distribution as markovify.combine."""
+
+    def __init__(self, chains):
+        self.chains = chains
+        self.state_size = chains[0].state_size
+
+    @property
+    def model(self):
+        return markovify.combine([chain.model for chain in self.chains])
+
+    def precompute_begin_state(self):
+        """Each component has already precomputed its own begin state."""
+
+    def move(self, state):
+        """Given a state, chooses the next word at random."""
+        cumulative_weights = list(accumulate(state_weight(chain, state) for chain in self.chains))
+        if cumulative_weights[-1] == 0:
+            raise KeyError(state)
+        index = bisect.bisect(cumulative_weights, random.random() * cumulative_weights[-1])
+        return self.chains[index].move(state)
+
+
+class MixtureText(markovify.Text):
+    """A markovify.Text sampling from a MixtureChain. Generated sentences are tested for overlap against each
+    component's original text."""
+
+    def __init__(self, models):
+        self.models = models
+        self.state_size = models[0].state_size
+        self.retain_original = any(model.retain_original for model in models)
+        self.chain = MixtureChain([model.chain for model in models])
+        if self.retain_original:
+            delegate_overlap_test(self)
+
+    def test_sentence_output(self, words, max_overlap_ratio, max_overlap_total):
+        """Rejects sentences that overlap too much with the text of any component."""
+        return all(model.test_sentence_output(words, max_overlap_ratio, max_overlap_total)
+                   for model in self.models if model.retain_original)
+
+    def make_sentence_with_start(self, beginning, strict=True, **kwargs):
+        """Same as markovify.Text.make_sentence_with_start, but looks for non-strict starting states in each
+        component."""
+        split = tuple(self.word_split(beginning))
+        if strict or not 0 < len(split) < self.state_size:
+            return super().make_sentence_with_start(beginning, strict, **kwargs)
+        init_states = list(OrderedDict.fromkeys(state for model in self.models
+                                                for state in states_starting_with(model.chain, split)))
+        random.shuffle(init_states)
+        for init_state in init_states:
+            output = self.make_sentence(init_state, **kwargs)
+            if output is not None:
+                return output
+        return None
+
+
+def convert_person_models(repo=PEOPLE_REPO):
+    """Converts every .json model in repo and the fanfic corpus to the binary chain format. Returns the number of
+    people converted."""
+    converted = 0
+    for file_name in os.listdir(repo):
+        if file_name.endswith(JSON_EXTENSION):
+            json_path = f'{repo}{file_name}'
+            write_chain_file(f'{json_path[:-len(JSON_EXTENSION)]}{CHAIN_EXTENSION}', load_model(json_path))
+            os.remove(json_path)
+            MODEL_CACHE.invalidate(json_path)
+            converted += 1
+    if os.path.exists(FANFIC_CORPUS_FILE):
+        write_chain_file(FANFIC_CHAIN_FILE, load_model(FANFIC_CORPUS_FILE))
+    return converted
 
 
 def parse_names(names_input, valid_names):
@@ -91,27 +1815,20 @@ def parse_names(names_input, valid_names):
     names = []
 
     for name in names_input:
-        current_name = []
         if name == RANDOM_TAG:
-            names.append(random.choice(VALID_NAMES))
+            names.append(valid_names.choice())
         elif name == ALL_TAG:
-            people = random.sample(VALID_NAMES, 5)
+            people = valid_names.sample(5)
             for person in people:
                 names.append(person)
         else:
-            for valid_name in valid_names:
-                if name == valid_name:
-                    names.append(valid_name)
-                    break
-                if name in valid_name:
-                    current_name.append(valid_name)
+            current_name = valid_names.find(name)
+            if not current_name:
+                raise NameNotFoundError(name)
+            elif len(current_name) == 1:
+                names.append(current_name[0])
             else:
-                if not current_name:
-                    raise NameNotFoundError(name)
-                elif len(current_name) == 1:
-                    names.append(current_name[0])
-                else:
-                    raise AmbiguousInputError(name, current_name)
+                raise AmbiguousInputError(name, current_name)
     else:
         return names
 
@@ -121,8 +1838,10 @@ def generate_models(repo, names):
     models = []
     for name in names:
         try:
-            with open(f'{repo}{name}.json', 'r', encoding='utf-8-sig') as json_file:
-                models.append(markovify.Text.from_json(ujson.load(json_file)))
+            if repo == PEOPLE_REPO:
+                models.append(load_person_model(name))
+            else:
+                models.append(MODEL_CACHE.get(f'{repo}{name}{JSON_EXTENSION}', load_model))
         except FileNotFoundError:
             raise FileNotFoundError()
 
@@ -131,23 +1850,32 @@ def generate_models(repo, names):
 
 def generate_markov(person, root):
     """Using a Markov model, generates a text string."""
+    return markov_sentence(person, root)[0]
+
+
+def markov_sentence(person, root):
+    """Generates a Markov sentence and returns it with the names of the people it was generated from, which are empty
+    if it is an error message."""
     namelist = person.lower().split('+')
     num_names = len(namelist)
     if num_names > MAX_NUM_OF_NAMES:
-        return [f'Error: Too many inputs ({num_names}).', DEFAULT_NAME]
+        return [f'Error: Too many inputs ({num_names}).', DEFAULT_NAME], []
 
+    STATS.count('markov.requests')
     try:
-        names = parse_names(namelist, VALID_NAMES)
-        models = generate_models(PEOPLE_REPO, names)
+        with STATS.timer('markov.parse_names'):
+            names = parse_names(namelist, get_valid_names())
+        with STATS.timer('markov.model'):
+            text_model = get_combined_model(names)
     except AmbiguousInputError as bad_input:
         return [f'Error: Input maps to multiple users ("{bad_input.name}" -> {bad_input.output}).',
-                DEFAULT_NAME]
+                DEFAULT_NAME], []
     except FileNotFoundError as no_file:
-        return [f'Error: File not found ({no_file.filename}.json).', DEFAULT_NAME]
+        return [f'Error: File not found ({no_file.filename}.json).', DEFAULT_NAME], []
     except NameNotFoundError as no_user:
-        return [f'Error: User not found ({no_user.name}).', DEFAULT_NAME]
+        return [f'Error: User not found ({no_user.name}).', DEFAULT_NAME], []
     except Exception:
-        return [f'Error: Unknown error.', DEFAULT_NAME]
+        return [f'Error: Unknown error.', DEFAULT_NAME], []
 
     nickname = ''
     for name in names:
@@ -161,117 +1889,375 @@ def generate_markov(person, root):
     else:
         nickname = nickname[:-1]
 
-    text_model = markovify.combine(models)
-
-    for _ in range(MAX_MARKOV_ATTEMPTS):
-        if root is None:
-            output = text_model.make_sentence(tries=MAX_MARKOV_ATTEMPTS)
+    with STATS.timer('markov.sentence'):
+        for attempt in range(1, MAX_MARKOV_ATTEMPTS + 1):
+            if root is None:
+                output = text_model.make_sentence(tries=MAX_MARKOV_ATTEMPTS)
+            else:
+                output = text_model.make_sentence_with_start(
+                    root, tries=MAX_MARKOV_ATTEMPTS, strict=False)
+            if output is not None:
+                STATS.count('markov.attempts', attempt)
+                return [output, nickname.title()], names
         else:
-            output = text_model.make_sentence_with_start(
-                root, tries=MAX_MARKOV_ATTEMPTS, strict=False)
-        if output is not None:
-            return [output, nickname.title()]
+            STATS.count('markov.attempts', MAX_MARKOV_ATTEMPTS)
+            STATS.count('markov.failures')
+            return ['Error: insufficient data for Markov chain.', DEFAULT_NAME], []
+
+
+def clean_name(name):
+    """Strips a Discord name down to the characters allowed in model file names."""
+    return "".join(c for c in name if c in PERMITTED_CHARS).lower()
+
+
+def group_messages_by_author(new_messages):
+    """Groups message contents by cleaned author name in a single pass over the messages. Authors with fewer than
+    MIN_NEW_MESSAGES messages are left out."""
+    lines_by_author = {}
+    names_by_author = {}
+    for message in new_messages:
+        author_lines = lines_by_author.get(message.author.id)
+        if author_lines is None:
+            author_lines = lines_by_author[message.author.id] = []
+            names_by_author[message.author.id] = clean_name(message.author.name)
+        author_lines.append(message.content)
+
+    lines_by_name = {}
+    for author_id, author_lines in lines_by_author.items():
+        if len(author_lines) >= MIN_NEW_MESSAGES:
+            lines_by_name.setdefault(names_by_author[author_id], []).extend(author_lines)
+    return lines_by_name
+
+
+def build_person_model(name, lines, exists, batch=None):
+    """Builds a model from a person's new messages and writes it, either as a delta for an existing person or as the
+    model file of a new one. Runs in a worker process, so it doesn't touch the name registry. Returns None, or an error
+    message if no model could be built, e.g. because markovify rejected every message."""
+    try:
+        new_model = markovify.NewlineText('\n'.join(lines))
+    except KeyError:
+        return f'could not build a model from {len(lines)} messages'
+    if exists:
+        append_person_delta(name, new_model, batch)
     else:
-        return ['Error: insufficient data for Markov chain.', DEFAULT_NAME]
+        save_person_model(name, new_model)
+    return None
+
+
+def update_people(new_messages, progress=None, checkpoint=None, carried=()):
+    """Updates current Markov models and writes them to the people repo. Returns the names of the updated people and
+    of the new people.
+
+    The batch is written to the update journal first, and an interrupted batch is finished before a new one starts,
+    see replay_update_journal. If given, checkpoint is the timestamp of the newest message, saved once the whole batch
+    has been written along with carried, the messages older than it that were held back for the next batch. Models are
+    built in a pool of UPDATE_MAX_WORKERS processes. If given, progress(done, total, name) is called after each person
+    has been written."""
+    replayed_names = replay_update_journal()
+    valid_names = get_valid_names()
+    people = {name: (lines, name in valid_names) for name, lines in group_messages_by_author(new_messages).items()}
+    journal = {
+        'batch': os.urandom(8).hex(),
+        'checkpoint': checkpoint.strftime(TIMESTAMP_FORMAT) if checkpoint is not None else None,
+        'carried': [carried_record(message) for message in carried],
+        'people': people
+    }
+    write_atomically(update_journal_file(), ujson.dumps(journal) + '\n')
+    updated_names, new_names = apply_update_journal(journal, set(), progress)
+    return updated_names + replayed_names[0], new_names + replayed_names[1]
+
+
+def update_journal_file():
+    """Returns the path of the journal of the update in progress, kept in the people repo."""
+    return f'{PEOPLE_REPO}{UPDATE_JOURNAL_FILE_NAME}'
+
+
+def replay_update_journal(progress=None):
+    """Finishes an update that was interrupted, e.g. by a crash, by writing every person its journal doesn't mark as
+    done. Returns the names of the updated and new people, which are empty if there was no interrupted update."""
+    try:
+        lines = read_lines_written(update_journal_file())
+    except FileNotFoundError:
+        return [], []
+    if not lines:
+        os.remove(update_journal_file())
+        return [], []
+    journal = ujson.loads(lines[0])
+    done = set(ujson.loads(line)['done'] for line in lines[1:])
+    return apply_update_journal(journal, done, progress)
+
+
+def apply_update_journal(journal, done, progress=None):
+    """Writes every person of an update journal except those in done, marking each in the journal once it has been
+    written. People whose model can't be built are reported, skipped and marked too, so they can't hold the journal
+    back. Then saves the journal's checkpoint and removes the journal."""
+    updated_names = []
+    new_names = []
+    journal_file = update_journal_file()
+
+
+    with ProcessPoolExecutor(max_workers=UPDATE_MAX_WORKERS) as executor:
+        futures = {}
+        for name, (lines, exists) in journal['people'].items():
+            if name not in done:
+                futures[executor.submit(build_person_model, name, lines, exists, journal['batch'])] = (name, exists)
+
+        for count, future in enumerate(as_completed(futures), 1):
+            name, exists = futures[future]
+            error = future.result()
+            append_line(journal_file, ujson.dumps({'done': name}))
+            if error is not None:
+                print(f'Skipped {name} in the Markov update: {error}.')
+            else:
+                invalidate_person(name)
+                if exists:
+                    updated_names.append(name)
+                else:
+                    record_people_change(added=[name])
+                    new_names.append(name)
 
 
-def update_markov_people(new_messages, authors):
-    """Updates current Markov models and outputs them as .json files. It finally returns a confirmation message."""
-    num_of_new_names = 0
-    num_of_updated_names = 0
-    num_of_messages = len(new_messages)
-    models = []
-    print("Updating Markov models...")
-    for index, author in enumerate(authors, 1):
-        print(str(index) + "/" + str(len(authors)) + ": " + author.name)
-        corpus = ''
-        count = 0
-
-        for message in new_messages:
-            if message.author.id == author.id:
-                corpus += message.content + '\n'
-                count += 1
-        if count > 2:
-            new_model = markovify.NewlineText(corpus)
-            models.append(new_model)
-            cleaned_name = "".join(c for c in author.name if c in PERMITTED_CHARS).lower()
-            try:
-                if cleaned_name in VALID_NAMES:
-                    num_of_updated_names += 1
-                    with open(f'{PEOPLE_REPO}{cleaned_name}.json', 'r', encoding='utf-8-sig') as json_file:
-                        original_model = markovify.NewlineText.from_json(ujson.load(json_file))
-                    updated_model = markovify.combine([original_model, new_model])
-                    new_json = updated_model.to_json()
-                    with open(f"{PEOPLE_REPO}{cleaned_name}.json", 'w') as json_file:
-                        ujson.dump(new_json, json_file)
-                else:
-                    new_json = new_model.to_json()
-                    VALID_NAMES.append(cleaned_name)
-                    num_of_new_names += 1
-                    with open(f"{PEOPLE_REPO}{cleaned_name}.json", 'w') as json_file:
-                        ujson.dump(new_json, json_file)
-            except FileNotFoundError:
-                return f"Error: File not found ({cleaned_name}.json)."
-            except Exception:
-                traceback.print_exc()
-                return f"Error: Unknown Error."
-        else:
-            print('User skipped due to inactivity.')
-    print("Update Successful.")
-    return f"Corpus successfully updated with {num_of_messages} new messages, " \
-           f"{num_of_updated_names} updated people, and {num_of_new_names} new people."
+            if progress is not None:
+                progress(count, len(futures), name)
+    SENTENCE_POOLS.invalidate(updated_names)
+    if new_names:
+        SENTENCE_POOLS.invalidate_kind('markov')
+
+    if journal['checkpoint'] is not None:
+        save_timestamp(datetime.datetime.strptime(journal['checkpoint'], TIMESTAMP_FORMAT),
+                       journal.get('carried', []))
+    os.remove(journal_file)
+    record_people_change()
+    return updated_names, new_names
+
+
+
+def update_markov_people(new_messages, progress=None):
+    """Updates current Markov models and writes them to the people repo. It finally returns a confirmation message."""
+    try:
+        updated_names, new_names = update_people(new_messages, progress)
+    except FileNotFoundError as no_file:
+        return f"Error: File not found ({no_file.filename})."
+    except Exception:
+        traceback.print_exc()
+        return f"Error: Unknown Error."
+    return f"Corpus successfully updated with {len(new_messages)} new messages, " \
+           f"{len(updated_names)} updated people, and {len(new_names)} new people."
+
+
+def split_update_batch(messages):
+    """Splits a batch of messages into those ready to be written and those from authors who don't have
+    MIN_NEW_MESSAGES messages in the batch yet, which are carried over to the next batch."""
+    counts = {}
+    for message in messages:
+        counts[message.author.id] = counts.get(message.author.id, 0) + 1
+    ready = [message for message in messages if counts[message.author.id] >= MIN_NEW_MESSAGES]
+    carried = [message for message in messages if counts[message.author.id] < MIN_NEW_MESSAGES]
+    return ready, carried
+
+
+def rename_person(before_name, after_name):
+    """Renames a person's model and returns a confirmation message."""
+    valid_names = get_valid_names()
+    before_name = before_name.lower()
+    if before_name not in valid_names:
+        return f'Error: Name not found ({before_name}).'
+
+    after_name = clean_name(after_name)
+    rename_person_model(before_name, after_name)
+    record_people_change(removed=[before_name], added=[after_name])
+    SENTENCE_POOLS.invalidate([before_name, after_name])
+    return f'{before_name} successfully renamed to {after_name}!'
+
+
+def merge_people(name1, name2, out_name):
+    """Merges the models of two people into a new model and returns a confirmation message."""
+    valid_names = get_valid_names()
+    name1 = name1.lower()
+    name2 = name2.lower()
+    for name in (name1, name2):
+        if name not in valid_names:
+            return f'Error: Name not found ({name}).'
+
+    out_name = clean_name(out_name)
+    if out_name == '':
+        return f'Error: At least one argument is blank.'
+    new_model = combine_models([load_person_model(name1), load_person_model(name2)])
+    # The merged model is written before the originals are removed, so a crash in between loses nothing.
+    with PERSON_LOCKS.writing(name1, name2, out_name):
+        save_person_model(out_name, new_model)
+        for name in (name1, name2):
+            if name != out_name:
+                remove_person_model(name)
+    record_people_change(removed=[name1, name2], added=[out_name])
+    SENTENCE_POOLS.invalidate([name1, name2, out_name])
+    return f'{name1} and {name2} successfully merged to {out_name}!'
+
+
+def remove_person(name):
+    """Deletes a person's model and returns a confirmation message."""
+    valid_names = get_valid_names()
+    name = name.lower()
+    if name not in valid_names:
+        return f'Error: Name not found ({name}).'
+
+    remove_person_model(name)
+    record_people_change(removed=[name])
+
+    SENTENCE_POOLS.invalidate([name])
+    return f'{name} successfully removed!'
 
 
 def assign_name():
     """Assigns a name from a pre-loaded list of characters."""
-    index = random.randint(0, len(CHARACTERS) - 1)
-    return CHARACTERS[index]
+    characters = get_characters()
+    index = random.randint(0, len(characters) - 1)
+    return characters[index]
 
 
 def is_valid_sentence(homosexual, gay, sentence, gender1_tag):
     """Determines based on the type of relationship whether a given sentence makes logical sense within a fanfic."""
-    sentence_words = [''.join(c for c in word if c not in string.punctuation) for word in sentence.lower().split()]
-    tags = [word.strip("'s") for word in sentence.split() if '$' in word]
+    if not homosexual:
+        return 'ALE2' not in sentence
 
-    if not homosexual and 'ALE2' in sentence:
-        return False
+    for tag in GENDER_TAG_PATTERN.findall(sentence):
+        if len(tag) != len(gender1_tag):
+            return False
 
-    is_tags_same_length = True
-    if len(tags) > 0:
-        tag_len = len(tags[0])
-        if len(gender1_tag) != tag_len:
-            is_tags_same_length = False
-        else:
-            for tag in tags:
-                if tag_len != len(tag):
-                    is_tags_same_length = False
-
-    if homosexual and not is_tags_same_length:
-        return False
-
-    if homosexual:
-        if gay:
-            for feminine_word, word in product(FEMININE_WORDS, sentence_words):
-                if word == feminine_word:
-                    return False
-        else:
-            for masculine_word, word in product(MASCULINE_WORDS, sentence_words):
-                if word == masculine_word:
-                    return False
-    return True
+    sentence_words = sentence.lower().translate(PUNCTUATION_TABLE).split()
+    if gay:
+        return get_feminine_words().isdisjoint(sentence_words)
+    return get_masculine_words().isdisjoint(sentence_words)
+
+
+FANFIC_MODEL = None
+FANFIC_MODEL_LOCK = threading.Lock()
+
+
+def get_fanfic_model():
+    """Returns the fanfic model, loading it from the corpus file the first time it is needed. The binary chain file
+    is used if one has been generated."""
+    global FANFIC_MODEL
+    with FANFIC_MODEL_LOCK:
+        if FANFIC_MODEL is None:
+            path = FANFIC_CHAIN_FILE if os.path.exists(FANFIC_CHAIN_FILE) else FANFIC_CORPUS_FILE
+            if SHARED_MODELS:
+                FANFIC_MODEL = load_shared_model(('fanfic',), file_stamp(path), lambda: load_model(path))
+            else:
+                FANFIC_MODEL = load_overlap_index(compile_model(load_model(path)), path)
+        return FANFIC_MODEL
+
+
+def reload_fanfic_model():
+    """Discards the resident fanfic model and loads the corpus file again."""
+    global FANFIC_MODEL
+    with FANFIC_MODEL_LOCK:
+        FANFIC_MODEL = None
+        CONSTRAINED_FANFIC_MODELS.clear()
+    SENTENCE_POOLS.invalidate([FANFIC_CORPUS_FILE])
+    return get_fanfic_model()
+
+
+CONSTRAINED_FANFIC_MODELS = {}
+
+
+def is_forbidden_word(word, homosexual, gay):
+    """Determines whether a single word would make is_valid_sentence reject any sentence containing it."""
+    if not homosexual:
+        return 'ALE2' in word
+    for tag in GENDER_TAG_PATTERN.findall(word):
+        if len(tag) != len('$MALE1' if gay else '$FEMALE1'):
+            return True
+    normalized_word = word.lower().translate(PUNCTUATION_TABLE)
+    if gay:
+        return normalized_word in get_feminine_words()
+    return normalized_word in get_masculine_words()
+
+
+def mask_chain(model, forbidden):
+    """Returns a copy of a chain's dict of dicts without transitions to forbidden words. Transitions into states
+    that can then only lead to forbidden words are removed as well, so every walk of the masked chain reaches END.
+    Returns None if no sentence can be generated at all."""
+    begin_state = (markovify.chain.BEGIN,) * len(next(iter(model)))
+    masked = {state: dict(options) for state, options in model.items()
+              if not any(word != markovify.chain.BEGIN and forbidden(word) for word in state)}
+
+    predecessors = {}
+    dead_states = []
+    for state, options in masked.items():
+        for word in list(options):
+            if word == markovify.chain.END:
+                continue
+            next_state = state[1:] + (word,)
+            if forbidden(word) or next_state not in masked:
+                del options[word]
+            else:
+                predecessors.setdefault(next_state, []).append((state, word))
+        if not options:
+            dead_states.append(state)
+
+    while dead_states:
+        dead_state = dead_states.pop()
+        for state, word in predecessors.get(dead_state, []):
+            options = masked[state]
+            if word in options:
+                del options[word]
+                if not options:
+                    dead_states.append(state)
+
+    masked = {state: options for state, options in masked.items() if options}
+    if begin_state not in masked:
+        return None
+    return masked
+
+
+class ConstrainedText(markovify.Text):
+    """A markovify.Text walking a masked copy of another model's chain. Overlap with the original text is still
+    tested against the unmasked model."""
+
+    def __init__(self, model, chain):
+        self.model = model
+        self.state_size = model.state_size
+        self.retain_original = model.retain_original
+        self.chain = compile_chain(markovify.Chain(None, model.state_size, chain))
+        if self.retain_original:
+            delegate_overlap_test(self)
+
+    def test_sentence_output(self, words, max_overlap_ratio, max_overlap_total):
+        return self.model.test_sentence_output(words, max_overlap_ratio, max_overlap_total)
+
+
+def get_fanfic_generator(homosexual, gay):
+    """Returns the model used to generate fanfic sentences for a type of relationship. With
+    CONSTRAINED_FANFIC_GENERATION, this is a model whose chain can only produce sentences is_valid_sentence accepts.
+    Masked chains are built on first use and kept until the fanfic model is reloaded."""
+    fanfic_model = get_fanfic_model()
+    if not CONSTRAINED_FANFIC_GENERATION:
+        return fanfic_model
+
+    key = (homosexual, gay)
+    with FANFIC_MODEL_LOCK:
+        if key not in CONSTRAINED_FANFIC_MODELS:
+            forbidden_words = {}
+
+            def forbidden(word):
+                if word not in forbidden_words:
+                    forbidden_words[word] = is_forbidden_word(word, homosexual, gay)
+                return forbidden_words[word]
+
+            chain = mask_chain(fanfic_model.chain.model, forbidden)
+            CONSTRAINED_FANFIC_MODELS[key] = fanfic_model if chain is None else ConstrainedText(fanfic_model, chain)
+        return CONSTRAINED_FANFIC_MODELS[key]
 
 
 def generate_fanfic(person1, person2, gender1, gender2):
     """Generates a fanfic with the given people and genders."""
-    if person1 is None:
-        person1 = assign_name()
-    if person2 is None:
-        person2 = assign_name()
-    if person1 == RANDOM_TAG:
-        person1 = random.choice(VALID_NAMES).title()
-    if person2 == RANDOM_TAG:
-        person2 = random.choice(VALID_NAMES).title()
+    tags = fanfic_tags(gender1, gender2)
+    return fill_fanfic(generate_fanfic_paragraph(*tags), person1, person2, tags[2], tags[3])
+
 
+def fanfic_tags(gender1, gender2):
+    """Returns whether the partners are the same sex, whether they are men, and the tags standing in for each."""
     homosexual = False   # 'homosexual' refers to whether the two partners are the same sex.
     gay = False   # 'gay' refers to whether the two partners are men.
 
@@ -290,16 +2276,35 @@ def generate_fanfic(person1, person2, gender1, gender2):
         else:
             gender2_tag = '$FEMALE2'
             homosexual = True
+    return homosexual, gay, gender1_tag, gender2_tag
 
-    with open(f'{FANFIC_REPO}fanficcorpus.json', 'r', encoding='utf-8-sig') as json_file:
-        fanfic_model = markovify.Text.from_json(ujson.load(json_file))
 
+def generate_fanfic_paragraph(homosexual, gay, gender1_tag, gender2_tag):
+    """Generates a paragraph of fanfic sentences using the gender tags in place of names. Returns an empty string if
+    no paragraph mentioning both tags could be made."""
+    with STATS.timer('fanfic.model'):
+        fanfic_model = get_fanfic_generator(homosexual, gay)
+
+    start = time.perf_counter()
+    num_sentences = 0
+    num_rejected = 0
     fanfic_attempts = 0
+    failed_batches = 0
+    sentences = []
     paragraph = ''
     topic_of_previous_sentence = ''
 
     while len(paragraph) < MAX_MESSAGE_LENGTH:
-        sentence = fanfic_model.make_sentence() + ' '
+        if not sentences:
+            sentences = make_sentences(fanfic_model, FANFIC_SENTENCE_BATCH_SIZE)
+            sentences.reverse()
+            if not sentences:
+                failed_batches += 1
+                if failed_batches > MAX_MARKOV_ATTEMPTS:
+                    break
+                continue
+        sentence = sentences.pop() + ' '
+        num_sentences += 1
         if is_valid_sentence(homosexual, gay, sentence, gender1_tag):
             if len(paragraph) + len(sentence) < MAX_MESSAGE_LENGTH:
                 paragraph += sentence
@@ -329,17 +2334,360 @@ def generate_fanfic(person1, person2, gender1, gender2):
                     fanfic_attempts += 1
                     if fanfic_attempts > 5:
                         break
-    if paragraph is not '':
+        else:
+            num_rejected += 1
+    STATS.record('fanfic.paragraph', time.perf_counter() - start)
+    STATS.count('fanfic.requests')
+    STATS.count('fanfic.sentences', num_sentences)
+    STATS.count('fanfic.rejected', num_rejected)
+    STATS.count('fanfic.restarts', fanfic_attempts)
+    if paragraph == '':
+        STATS.count('fanfic.failures')
+    return paragraph
+
+
+def fill_fanfic(paragraph, person1, person2, gender1_tag, gender2_tag):
+    """Replaces the gender tags of a fanfic paragraph with the given people, or with random ones if they are None or
+    RANDOM_TAG."""
+    if person1 is None:
+        person1 = assign_name()
+    if person2 is None:
+        person2 = assign_name()
+    if person1 == RANDOM_TAG:
+        person1 = get_valid_names().choice().title()
+    if person2 == RANDOM_TAG:
+        person2 = get_valid_names().choice().title()
+
+    if paragraph != '':
         return paragraph.replace(gender1_tag, person1).replace(gender2_tag, person2)
     else:
         return f'Error: Fanfic could not be created using tags {gender1_tag} and {gender2_tag}.'
 
 
+class SentencePools():
+    """Sentences generated ahead of time, in one pool per generator key, so that bursts of commands can be answered
+    without waiting for generation. The Markov cog keeps every pool filled to a depth of depth items in the background;
+    at most max_pools pools are kept, least recently used first out.
+
+    Each item records the names of the people whose models it came from, so invalidate() can drop the items made from
+    models that have since changed."""
+
+    def __init__(self, depth, max_pools):
+        self.depth = depth
+        self.max_pools = max_pools
+        self.pools = OrderedDict()
+        self.lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def take(self, key, func, *args):
+        """Returns an item from the pool for key and marks the pool as used, or returns None if it is empty. The pool
+        is created if needed and refilled with func(*args), which returns an item, or None, and the names it used."""
+        with self.lock:
+            if key not in self.pools:
+                self.pools[key] = (func, args, [])
+                while len(self.pools) > self.max_pools:
+                    self.pools.popitem(last=False)
+            self.pools.move_to_end(key)
+            items = self.pools[key][2]
+            if items:
+                self.hits += 1
+                return items.pop(0)[0]
+            self.misses += 1
+            return None
+
+    def wanted(self):
+        """Returns (key, func, args, version) for every pool that isn't full yet."""
+        with self.lock:
+            return [(key, func, args, self.version) for key, (func, args, items) in self.pools.items()
+                    if len(items) < self.depth]
+
+    def put(self, key, version, item, names):
+        """Adds an item made by a pool's function to it, unless the pool was invalidated since version. If the
+        function failed to make one, the pool is dropped, so inputs that only give errors aren't generated again."""
+        with self.lock:
+            if key not in self.pools or len(self.pools[key][2]) >= self.depth:
+                return
+            if item is None:
+                del self.pools[key]
+                return
+            if version != self.version:
+                self.discarded += 1
+                return
+            self.pools[key][2].append((item, frozenset(names)))
+
+    def invalidate(self, names):
+        """Drops every item made from the models of the given people."""
+        names = set(names)
+        with self.lock:
+            self.version += 1
+            for key, (func, args, items) in self.pools.items():
+                kept = [item for item in items if not names & item[1]]
+                self.discarded += len(items) - len(kept)
+                items[:] = kept
+
+    def invalidate_kind(self, kind):
+        """Drops every item from the pools whose keys start with kind, e.g. when new people change which models
+        their inputs choose from."""
+        with self.lock:
+            self.version += 1
+            for key, (func, args, items) in self.pools.items():
+                if key[0] == kind:
+                    self.discarded += len(items)
+                    items.clear()
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'pools': len(self.pools), 'depth': sum(len(items) for _, _, items in self.pools.values()),
+                    'hits': self.hits, 'misses': self.misses, 'discarded': self.discarded,
+                    'hit_rate': self.hits / requests if requests else 0.0}
+
+
+SENTENCE_POOLS = SentencePools(SENTENCE_POOL_DEPTH, SENTENCE_POOL_MAX_POOLS)
+
+
+def pooled_markov(person):
+    """Generates an item for a Markov sentence pool."""
+    output, names = markov_sentence(person, None)
+    return (output if names else None), names
+
+
+def pooled_fanfic(homosexual, gay, gender1_tag, gender2_tag):
+    """Generates an item for a fanfic paragraph pool."""
+    return generate_fanfic_paragraph(homosexual, gay, gender1_tag, gender2_tag) or None, [FANFIC_CORPUS_FILE]
+
+
+def reset_locks_in_child():
+    """Replaces the module's locks in a forked worker process. A lock held by another thread at the moment of the fork
+    would otherwise stay held forever in the worker, which doesn't have that thread."""
+    global PERSON_LOCKS, VALID_NAMES_LOCK, FANFIC_MODEL_LOCK
+    PERSON_LOCKS = PersonLocks()
+    VALID_NAMES_LOCK = threading.Lock()
+    FANFIC_MODEL_LOCK = threading.Lock()
+    for owner in (MODEL_CACHE, COMBINED_MODEL_CACHE, STATS, SENTENCE_POOLS, VALID_NAMES):
+        if owner is not None:
+            owner.lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_locks_in_child)
+
+
+def stats_report():
+    """Returns the per-stage latencies, attempt counts, failure rates and cache usage reported by `markov stats`."""
+    lines = [f"{'stage':<20}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"]
+    for stage, (count, p50, p90, p99) in sorted(STATS.percentiles().items()):
+        lines.append(f'{stage:<20}{count:>7}{p50:>10.2f}{p90:>10.2f}{p99:>10.2f}')
+    counters = STATS.counters
+    lines.append('')
+    lines.append(f"markov: {counters.get('markov.requests', 0)} requests, "
+                 f"{STATS.rate('markov.attempts', 'markov.requests'):.2f} attempts each, "
+                 f"{STATS.rate('markov.failures', 'markov.requests'):.1%} failed")
+    lines.append(f"fanfic: {counters.get('fanfic.requests', 0)} requests, "
+                 f"{STATS.rate('fanfic.rejected', 'fanfic.sentences'):.1%} of sentences rejected, "
+                 f"{STATS.rate('fanfic.restarts', 'fanfic.requests'):.2f} restarts each, "
+                 f"{STATS.rate('fanfic.failures', 'fanfic.requests'):.1%} failed")
+    lines.append(f"sentences: {STATS.rate('sentences.overlapping', 'sentences.walked'):.1%} overlapped the corpus, "
+                 f"{counters.get('generate.timeouts', 0)} generations timed out")
+    lines.append(f"nicknames: {counters.get('discord.nick_edits_skipped', 0)} edits skipped, "
+                 f"{counters.get('discord.nick_edits_coalesced', 0)} coalesced")
+    for label, cache in (('model cache', MODEL_CACHE), ('combined cache', COMBINED_MODEL_CACHE)):
+        cache_stats = cache.stats()
+        lines.append(f"{label}: {cache_stats['entries']} entries, {cache_stats['bytes'] / 2 ** 20:.1f} MiB, "
+                     f"{cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                     f"{cache_stats['evictions']} evictions")
+    pool_stats = SENTENCE_POOLS.stats()
+    lines.append(f"pools: {pool_stats['depth']} items in {pool_stats['pools']} pools, "
+                 f"{pool_stats['hit_rate']:.1%} hit rate")
+    return '```\n' + '\n'.join(lines)[:MAX_MESSAGE_LENGTH - 8] + '\n```'
+
+
+def profile_report(profile):
+    """Returns the functions with the most cumulative time in a profile, formatted to fit in a message."""
+    output = io.StringIO()
+    profile.stream = output
+    profile.sort_stats('cumulative').print_stats(15)
+    return '```\n' + output.getvalue().strip()[:MAX_MESSAGE_LENGTH - 8] + '\n```'
+
+
+def profiled_call(func, *args):
+    """Runs a generation function in a worker, sampled by the profiler of the worker's process."""
+    return STATS.call(func, *args)
+
+
+def create_executor():
+    """Creates the worker pool used for generation, as configured by EXECUTOR_KIND."""
+    if EXECUTOR_KIND == 'process':
+        return ProcessPoolExecutor(max_workers=EXECUTOR_MAX_WORKERS)
+    return ThreadPoolExecutor(max_workers=EXECUTOR_MAX_WORKERS)
+
+
 class Markov():
     """Defines Markov commands."""
 
     def __init__(self, bot):
         self.bot = bot
+        self.executor = create_executor()
+        self.update_executor = ThreadPoolExecutor(max_workers=1)
+        self.generation_semaphore = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+        self.compaction_task = self.bot.loop.create_task(self.compact_periodically())
+        self.bot.loop.create_task(self.replay_update())
+        self.pool_refill = asyncio.Event()
+        self.pool_task = self.bot.loop.create_task(self.refill_pools()) if USE_SENTENCE_POOLS else None
+        self.member_names = {}
+        self.nicknames = {}
+        self.wanted_nicknames = {}
+        self.nickname_locks = {}
+
+    def __unload(self):
+        self.compaction_task.cancel()
+        if self.pool_task is not None:
+            self.pool_task.cancel()
+        self.executor.shutdown(wait=False)
+        self.update_executor.shutdown(wait=False)
+
+    async def generate(self, func, *args):
+        """Runs a generation function in the worker pool, at most MAX_CONCURRENT_GENERATIONS at a time. Raises
+        asyncio.TimeoutError if it takes longer than GENERATION_TIMEOUT seconds. A worker can't be stopped, so a
+        generation that times out keeps its slot until it actually finishes."""
+        start = time.perf_counter()
+        await self.generation_semaphore.acquire()
+        STATS.record('generate.queue', time.perf_counter() - start)
+        try:
+            future = self.bot.loop.run_in_executor(self.executor, profiled_call, func, *args)
+        except BaseException:
+            self.generation_semaphore.release()
+            raise
+        future.add_done_callback(self.generation_finished)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), GENERATION_TIMEOUT)
+        except asyncio.TimeoutError:
+            STATS.count('generate.timeouts')
+            raise
+        finally:
+            STATS.record('generate.total', time.perf_counter() - start)
+
+    def generation_finished(self, future):
+        """Frees the slot of a finished generation. The result of one that timed out is dropped."""
+        self.generation_semaphore.release()
+        if not future.cancelled():
+            future.exception()
+
+    async def mutate(self, func, *args):
+        """Runs a function that changes the people repo in the update thread, then restarts a process pool so that
+        its workers don't keep serving the old list of names."""
+        result = await self.bot.loop.run_in_executor(self.update_executor, func, *args)
+        if EXECUTOR_KIND == 'process':
+            self.executor.shutdown(wait=False)
+            self.executor = create_executor()
+        return result
+
+    async def replay_update(self):
+        """Finishes an update that was interrupted when the bot last stopped."""
+        try:
+            updated_names, new_names = await self.mutate(replay_update_journal)
+        except Exception:
+            traceback.print_exc()
+            return
+        if updated_names or new_names:
+            print(f'Finished an interrupted update of {len(updated_names)} people and {len(new_names)} new people.')
+
+    async def compact_periodically(self):
+        """Merges pending delta files into the people's model files every COMPACTION_INTERVAL seconds."""
+        while True:
+            await asyncio.sleep(COMPACTION_INTERVAL)
+            try:
+                await self.mutate(compact_people)
+            except Exception:
+                traceback.print_exc()
+
+    async def refill_pools(self):
+        """Keeps the sentence pools filled, one item at a time and only while no command is waiting for a worker.
+        Sleeps until a pool is used once they are all full."""
+        while True:
+            wanted = SENTENCE_POOLS.wanted()
+            if not wanted:
+                self.pool_refill.clear()
+                await self.pool_refill.wait()
+                continue
+            for key, func, args, version in wanted:
+                while self.generation_semaphore.locked():
+                    await asyncio.sleep(SENTENCE_POOL_REFILL_INTERVAL)
+                try:
+                    item, names = await self.generate(func, *args)
+                except Exception:
+                    traceback.print_exc()
+                    await asyncio.sleep(SENTENCE_POOL_REFILL_INTERVAL)
+                    continue
+                SENTENCE_POOLS.put(key, version, item, names)
+
+    async def pooled(self, key, func, *args):
+        """Returns an item from the sentence pool for key, or None if pools are disabled or it is empty, and wakes the
+        refill task."""
+        if not USE_SENTENCE_POOLS:
+            return None
+        item = SENTENCE_POOLS.take(key, func, *args)
+        self.pool_refill.set()
+        return item
+
+    def member_name(self, guild, member_id):
+        """Returns the display name of a guild member, cached until the member changes or leaves."""
+        names = self.member_names.setdefault(guild.id, {})
+        name = names.get(member_id)
+        if name is None:
+            member = guild.get_member(member_id)
+            if member is None:
+                return 'UNKNOWN_USER'
+            name = names[member_id] = member.display_name
+        return name
+
+    def resolve_mentions(self, guild, text):
+        """Replaces the user mentions in a text with the members' display names."""
+        return MENTION_PATTERN.sub(lambda mention: '@' + self.member_name(guild, int(mention.group(1))), text)
+
+    async def set_nickname(self, guild, nickname):
+        """Changes the bot's nickname in a guild, unless it already has it. Edits requested while another is in
+        progress are coalesced, so only the latest of them is made."""
+        self.wanted_nicknames[guild.id] = nickname
+        lock = self.nickname_locks.setdefault(guild.id, asyncio.Lock())
+        async with lock:
+            if self.wanted_nicknames.get(guild.id) != nickname:
+                STATS.count('discord.nick_edits_coalesced')
+                return
+            if self.nicknames.get(guild.id, guild.me.nick) == nickname:
+                STATS.count('discord.nick_edits_skipped')
+                return
+            with STATS.timer('discord.nick_edit'):
+                await guild.me.edit(nick=nickname)
+            self.nicknames[guild.id] = nickname
+
+    async def on_member_update(self, before, after):
+        self.member_names.get(after.guild.id, {}).pop(after.id, None)
+        if after.id == after.guild.me.id:
+            self.nicknames[after.guild.id] = after.nick
+
+    async def on_member_remove(self, member):
+        self.member_names.get(member.guild.id, {}).pop(member.id, None)
+
+    async def on_guild_remove(self, guild):
+        for cache in (self.member_names, self.nicknames, self.wanted_nicknames, self.nickname_locks):
+            cache.pop(guild.id, None)
+
+    def progress_reporter(self, status, label):
+        """Returns a progress callback that can be called from a worker thread. It edits the status message at most
+        once every UPDATE_PROGRESS_INTERVAL seconds."""
+        last_report = [0]
+
+        def report(done, total, name):
+            now = time.monotonic()
+            if done == total or now - last_report[0] >= UPDATE_PROGRESS_INTERVAL:
+                last_report[0] = now
+                asyncio.run_coroutine_threadsafe(status.edit(content=f'{label}: {done}/{total} ({name})'),
+                                                 self.bot.loop)
+        return report
 
     @commands.group(aliases=['mk', 'rmk'], invoke_without_command=True)
     async def markov(self, ctx, person=REFLEXIVE_TAG, root=None):
@@ -348,83 +2696,96 @@ class Markov():
             person = ALL_TAG
         if REFLEXIVE_TAG in person:
             person = person.replace(REFLEXIVE_TAG, ctx.author.name)
-        out = generate_markov(person, root)
-        user_tags = set([c for c in out[0].split(' ') if c[0:2] == '<@'])
-        current_guild = ctx.message.guild
-        bot_self = current_guild.me
-        for user_tag in user_tags:
-            id = int(re.sub('\D','',user_tag))
-            username = current_guild.get_member(id)
-            if username is not None:
-                username = username.display_name
-                out[0] = out[0].replace(user_tag, '@' + username)
-            elif user_tag in out[0]:
-                out[0] = out.replace(user_tag, "@UNKNOWN_USER")
+        out = None
+        if root is None and person in (RANDOM_TAG, ALL_TAG):
+            out = await self.pooled(('markov', person), pooled_markov, person)
+        try:
+            if out is None:
+                out = await self.generate(generate_markov, person, root)
+        except asyncio.TimeoutError:
+            await ctx.send(TIMEOUT_ERROR_STRING)
+            return
+        out[0] = self.resolve_mentions(ctx.guild, out[0])
         if person == ALL_TAG:
             out[1] = ctx.guild.name.title()
-        await bot_self.edit(nick=out[1])
+        await self.set_nickname(ctx.guild, out[1])
         await ctx.send(out[0])
 
     @markov.command(name='rename', hidden=True)
     async def _rename(self, ctx, before_name, after_name):
-        if ctx.author.id == MARKOV_MODULE_CREATORS_ID:
-            before_name = before_name.lower()
-
-            if before_name in VALID_NAMES:
-                after_name = "".join(c for c in after_name if c in PERMITTED_CHARS).lower()
-                with open(f'{PEOPLE_REPO}{before_name}.json', 'r', encoding='utf-8-sig') as json_file:
-                    json_model = ujson.load(json_file)
-                with open(f"{PEOPLE_REPO}{after_name}.json", 'w') as json_file:
-                    ujson.dump(json_model, json_file)
-                VALID_NAMES.remove(before_name)
-                VALID_NAMES.append(after_name)
-                os.remove(f'{PEOPLE_REPO}{before_name}.json')
-                await ctx.send(f'{before_name} successfully renamed to {after_name}!')
-            else:
-                await ctx.send(f'Error: Name not found ({before_name}).')
+        if ctx.author.id == get_creator_id():
+            await ctx.send(await self.mutate(rename_person, before_name, after_name))
         else:
             await ctx.send(PERMISSION_ERROR_STRING)
 
     @markov.command(name='merge', hidden=True)
     async def _merge(self, ctx, name1, name2, out_name):
-        if ctx.author.id == MARKOV_MODULE_CREATORS_ID:
-            name1 = name1.lower()
-            name2 = name2.lower()
-
-            if name1 in VALID_NAMES and name2 in VALID_NAMES:
-                if name1 == '' or name2 == '' or out_name == '':
-                    await ctx.send(f'Error: At least one argument is blank.')
-                out_name = "".join(c for c in out_name if c in PERMITTED_CHARS).lower()
-                with open(f'{PEOPLE_REPO}{name1}.json', 'r', encoding='utf-8-sig') as json_file:
-                    name1_model = markovify.NewlineText.from_json(ujson.load(json_file))
-                with open(f'{PEOPLE_REPO}{name2}.json', 'r', encoding='utf-8-sig') as json_file:
-                    name2_model = markovify.NewlineText.from_json(ujson.load(json_file))
-                new_model = markovify.combine([name1_model, name2_model])
-                new_json = new_model.to_json()
-                with open(f"{PEOPLE_REPO}{out_name}.json", 'w') as json_file:
-                    ujson.dump(new_json, json_file)
-                VALID_NAMES.remove(name1)
-                VALID_NAMES.remove(name2)
-                VALID_NAMES.append(out_name)
-                os.remove(f'{PEOPLE_REPO}{name1}.json')
-                os.remove(f'{PEOPLE_REPO}{name2}.json')
-                await ctx.send(f'{name1}.json and {name2}.json successfully merged to {out_name}.json!')
-            else:
-                await ctx.send(f'Error: Name not found ({before_name}).')
+        if ctx.author.id == get_creator_id():
+            await ctx.send(await self.mutate(merge_people, name1, name2, out_name))
         else:
             await ctx.send(PERMISSION_ERROR_STRING)
 
     @markov.command(name='remove', hidden=True)
     async def _remove(self, ctx, name):
-        if ctx.author.id == MARKOV_MODULE_CREATORS_ID:
-            name = name.lower()
+        if ctx.author.id == get_creator_id():
+            await ctx.send(await self.mutate(remove_person, name))
+        else:
+            await ctx.send(PERMISSION_ERROR_STRING)
 
-            if name in VALID_NAMES:
-                os.remove(f'{PEOPLE_REPO}{name}.json')
-                VALID_NAMES.remove(name)
-                await ctx.send(f'{name}.json successfully removed!')
-            else:
-                await ctx.send(f'Error: Name not found ({before_name}).')
+    @markov.command(name='convert', hidden=True)
+    async def _convert(self, ctx):
+        if ctx.author.id == get_creator_id():
+            num_converted = await self.mutate(convert_person_models)
+            await self.mutate(reload_fanfic_model)
+            await ctx.send(f'{num_converted} models successfully converted to the binary chain format!')
+        else:
+            await ctx.send(PERMISSION_ERROR_STRING)
+
+    @markov.command(name='reloadfanfic', hidden=True)
+    async def _reload_fanfic(self, ctx):
+        if ctx.author.id == get_creator_id():
+            try:
+                await self.mutate(reload_fanfic_model)
+            except FileNotFoundError:
+                await ctx.send(f'Error: File not found ({FANFIC_CORPUS_FILE}).')
+                return
+            await ctx.send('Fanfic corpus successfully reloaded!')
+        else:
+            await ctx.send(PERMISSION_ERROR_STRING)
+
+    @markov.command(name='pools', hidden=True)
+    async def _pools(self, ctx):
+        if ctx.author.id == get_creator_id():
+            stats = SENTENCE_POOLS.stats()
+            await ctx.send(f"{stats['pools']} pools holding {stats['depth']} items. "
+                           f"Hit rate: {stats['hit_rate']:.1%} ({stats['hits']} hits, {stats['misses']} misses), "
+                           f"{stats['discarded']} items discarded after model changes.")
+        else:
+            await ctx.send(PERMISSION_ERROR_STRING)
+
+    @markov.group(name='stats', hidden=True, invoke_without_command=True)
+    async def _stats(self, ctx):
+        if ctx.author.id == get_creator_id():
+            await ctx.send(stats_report())
+        else:
+            await ctx.send(PERMISSION_ERROR_STRING)
+
+    @_stats.command(name='profile')
+    async def _profile(self, ctx, every: int = 0):
+        """Samples one in every generations with cProfile, or stops sampling if every is 0. Sends the profile
+        collected since the last call."""
+        if ctx.author.id == get_creator_id():
+            profile = STATS.set_profiling(every)
+            status = f'Profiling one in {every} generations.' if every else 'Profiling stopped.'
+            await ctx.send(status if profile is None else f'{status}\n{profile_report(profile)}')
+        else:
+            await ctx.send(PERMISSION_ERROR_STRING)
+
+    @_stats.command(name='reset')
+    async def _reset_stats(self, ctx):
+        if ctx.author.id == get_creator_id():
+            STATS.clear()
+            await ctx.send('Stats successfully reset!')
         else:
             await ctx.send(PERMISSION_ERROR_STRING)
 
@@ -433,7 +2794,7 @@ class Markov():
         """Lists the people from which you can generate Markov chains."""
         out = []
         message = ''
-        for valid_name in VALID_NAMES:
+        for valid_name in get_valid_names():
             if len(message) + len(valid_name) < MAX_MESSAGE_LENGTH:
                 message += valid_name + ', '
             else:
@@ -447,26 +2808,70 @@ class Markov():
     @markov.command(name='updatemarkov', aliases=['um'], hidden=True)
     async def _update(self, ctx):
         """Updates the corpus for the Markov module."""
-        if ctx.author.id == MARKOV_MODULE_CREATORS_ID:
-            await ctx.send("Beginning update...")
-            new_messages = []
-            authors = []
-            last_timestamp = load_timestamp()
-            print("Fetching history...")
-            history = await ctx.channel.history(after=last_timestamp, limit=None).flatten()
-            print("Filtering messages...")
-            for message in history:
-                if not message.content.startswith(FILTERED_PREFIXES) and not message.author.bot:
-                    new_messages.append(message)
-                    authors.append(message.author)
-                    creation_time = message.created_at
-                    if creation_time > last_timestamp:
-                        last_timestamp = creation_time
-            await ctx.send(update_markov_people(new_messages, set(authors)))
-            save_timestamp(last_timestamp)
+        if ctx.author.id == get_creator_id():
+            status = await ctx.send("Beginning update...")
+            checkpoint = load_timestamp()
+            carried = load_carried_messages()
+            batch = []
+            num_of_messages = 0
+            updated_names = set()
+            new_names = set()
+            async for message in ctx.channel.history(after=checkpoint, limit=None):
+                if message.content.startswith(FILTERED_PREFIXES) or message.author.bot:
+                    continue
+                batch.append(message)
+                checkpoint = message.created_at
+                if len(batch) < UPDATE_BATCH_SIZE:
+                    continue
+
+                ready, carried = split_update_batch(carried + batch)
+                batch = []
+                if not ready:
+                    continue
+                try:
+                    batch_updated_names, batch_new_names = await self.update_batch(status, ready, num_of_messages,
+                                                                                   checkpoint, carried)
+                except Exception as error:
+                    await ctx.send(self.update_error(error))
+                    return
+                num_of_messages += len(ready)
+                updated_names.update(batch_updated_names)
+                new_names.update(batch_new_names)
+
+            batch = carried + batch
+            if batch:
+                try:
+                    batch_updated_names, batch_new_names = await self.update_batch(status, batch, num_of_messages,
+                                                                                   checkpoint, [])
+                except Exception as error:
+                    await ctx.send(self.update_error(error))
+                    return
+                num_of_messages += len(batch)
+                updated_names.update(batch_updated_names)
+                new_names.update(batch_new_names)
+            await ctx.send(f"Corpus successfully updated with {num_of_messages} new messages, "
+                           f"{len(updated_names - new_names)} updated people, and {len(new_names)} new people.")
         else:
             await ctx.send(PERMISSION_ERROR_STRING)
 
+    async def update_batch(self, status, messages, num_of_previous_messages, checkpoint, carried):
+        """Writes a batch of new messages to the people repo, then checkpoints checkpoint, the timestamp of the newest
+        message read, together with the carried messages held back for the next batch, so an interrupted update
+        resumes after it without losing them. Returns the names of the updated and new people."""
+        progress = self.progress_reporter(status, f'Updating Markov models '
+                                                  f'(messages {num_of_previous_messages + 1}-'
+                                                  f'{num_of_previous_messages + len(messages)})')
+        return await self.mutate(update_people, messages, progress, checkpoint, carried)
+
+
+    @staticmethod
+    def update_error(error):
+        """Returns the message reported when a batch fails."""
+        if isinstance(error, FileNotFoundError):
+            return f"Error: File not found ({error.filename}). Progress up to the last batch was saved."
+        traceback.print_exception(type(error), error, error.__traceback__)
+        return "Error: Unknown Error. Progress up to the last batch was saved."
+
     @commands.command(aliases=['ff'])
     async def fanfic(self, ctx, person1=None, person2=None, gender1='man', gender2='woman'):
         """Generates a paragraph of Markov sentences based on works from fanfiction.net."""
@@ -474,10 +2879,19 @@ class Markov():
             person1 = ctx.author.name
         if person2 == REFLEXIVE_TAG:
             person2 = ctx.author.name
-        out = generate_fanfic(person1, person2, gender1, gender2)
+        tags = fanfic_tags(gender1, gender2)
+        paragraph = await self.pooled(('fanfic',) + tags, pooled_fanfic, *tags)
+        try:
+            if paragraph is None:
+                paragraph = await self.generate(generate_fanfic_paragraph, *tags)
+            out = fill_fanfic(paragraph, person1, person2, tags[2], tags[3])
+        except asyncio.TimeoutError:
+            out = TIMEOUT_ERROR_STRING
         await ctx.send(out)
 
 
 def setup(bot):
     """Adds the cog to the bot."""
+    if WARM_FANFIC_MODEL:
+        get_fanfic_model()
     bot.add_cog(Markov(bot))
@@ -1,49 +1,95 @@
-import markovify
+"""Builds Markov models for every regular in a Discord chat log export and writes them as .json files that can be
+copied into the people repo. Run it from the bot's root directory, e.g.
+
+    python cogs/markov/resources/r_server_parser.py runescape_general.txt --output ./subs/markov/resources/people/
+
+The log is read one line at a time and every message is assigned to its author in a single pass, then the authors'
+models are built and written in a pool of worker processes."""
+import argparse
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import markovify
 
 PERMITTED_CHARS = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_-"
 
-f = open('./cogs/markov/resources/runescape_general.txt', "r", encoding="utf-8-sig")
-lines = f.readlines()
+DEFAULT_INPUT_FILE = './cogs/markov/resources/runescape_general.txt'
+DEFAULT_OUTPUT_DIRECTORY = './cogs/markov/resources/rjson/'
+DEFAULT_MIN_MESSAGES = 500
+HEADER_LINES = 8
+
+
+def clean_name(name):
+    """Strips a Discord name down to the characters allowed in model file names."""
+    return "".join(c for c in name if c in PERMITTED_CHARS).lower()
+
 
-names = []
-messages = []
+def read_messages(path, skip_lines=HEADER_LINES):
+    """Reads a chat log and returns {cleaned author name: [messages]}.
 
-current_name = ""
+    After the export's header, a line starting a new block (one that follows a blank line and contains the 'AM]' or
+    'PM]' of its timestamp) names the author as 'name#discriminator', and the non-blank lines until the next such line
+    are their messages."""
+    messages_by_name = {}
+    current_messages = None
+    previous_line = ''
+    with open(path, 'r', encoding='utf-8-sig') as log_file:
+        for line_number, line in enumerate(log_file):
+            if line_number < skip_lines or line == '\n':
+                previous_line = line
+                continue
+            if previous_line == '\n' and 'M]' in line:
+                current_messages = messages_by_name.setdefault(clean_name(line.split('#')[0]), [])
+            elif current_messages is not None:
+                current_messages.append(line.rstrip('\n'))
+            previous_line = line
+    return messages_by_name
 
-for i in range(8, len(lines)):
-    current_line = lines[i]
 
-    if current_line != '\n':
-        if lines[i - 1] == '\n' and current_line.find('M]') > -1:
-            current_name = current_line.split('#')[0]
-        else:
-            messages.append((current_name, current_line[:-1]))
+def write_model(name, messages, output_directory):
+    """Builds a person's model and writes it as {output_directory}{name}.json, in the format the Markov module reads.
+    Returns the name and None, or the name and an error message if no model could be built."""
+    try:
+        text_model = markovify.NewlineText('\n'.join(messages))
+    except KeyError:
+        return name, f'could not build a model from {len(messages)} messages'
 
-for m in messages:
-    names.append(m[0])
+    path = os.path.join(output_directory, f'{name}.json')
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump(text_model.to_json(), json_file)
+    os.replace(temp_path, path)
+    return name, None
 
-names = list(set(names))
-print(len(names))
 
-for x in range(len(names)):
-    print(str(x + 1) + "/" + str(len(names)))
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='?', default=DEFAULT_INPUT_FILE, help='Chat log to read.')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT_DIRECTORY, help='Directory to write the models to.')
+    parser.add_argument('--min-messages', type=int, default=DEFAULT_MIN_MESSAGES,
+                        help='Only write models for people with at least this many messages.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of processes building models.')
+    parser.add_argument('--skip-lines', type=int, default=HEADER_LINES,
+                        help='Number of header lines at the start of the log.')
+    args = parser.parse_args()
 
-    person_messages = ""
+    messages_by_name = read_messages(args.input, args.skip_lines)
+    people = {name: messages for name, messages in messages_by_name.items()
+              if name != '' and len(messages) >= args.min_messages}
+    print(f'Found {len(messages_by_name)} people, {len(people)} with at least {args.min_messages} messages.')
 
-    for i in range(len(messages)):
-        if messages[i][0] == names[x]:
-            person_messages += messages[i][1] + '\n'
+    os.makedirs(args.output, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(write_model, name, messages, args.output) for name, messages in people.items()]
+        for done, future in enumerate(as_completed(futures), 1):
+            name, error = future.result()
+            if error is None:
+                print(f'{done}/{len(futures)}: {name}')
+            else:
+                print(f'{done}/{len(futures)}: {name} skipped, {error}')
 
-    names[x] = "".join(c for c in names[x] if c in PERMITTED_CHARS)
 
-    if person_messages != "" and person_messages.count('\n') > 499:
-        print("Found a user to add!")
-        try:
-            text_model = markovify.NewlineText(person_messages)
-        except KeyError:
-            for m in person_messages.split('\n'):
-                print(names[x] + ": " + m)
-        cache = text_model.to_json()
-        with open(f"./cogs/markov/resources/rjson/{names[x].lower()}.json", 'w') as f:
-            json.dump(cache, f)
+if __name__ == '__main__':
+    main()